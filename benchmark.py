@@ -0,0 +1,371 @@
+"""
+Offline benchmark for the polling pipeline.
+
+Runs check_canvas against a fake Canvas server on localhost and an in-memory Discord sink, then
+prints the results as JSON. Every random choice is seeded, so two runs with the same arguments
+do the same work and their results can be compared between versions of the bot:
+
+    python benchmark.py --courses 1000 --modules 200 --channels 5000 --output before.json
+    python benchmark.py --courses 1000 --modules 200 --channels 5000 --compare before.json
+
+Every run also checks that each new module was found, and exits with status 1 if one was missed
+while no failures were injected. For example, this run adds a module to every course that only
+fits on a new page, while the full first page is still reported as unchanged:
+
+    python benchmark.py --courses 5 --modules 100 --items 2 --channels 5 --watchers-per-channel 5 --change-rate 1.0
+"""
+
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+
+class FakeCanvas:
+    """
+    A local stand-in for the parts of the Canvas API that the bot uses. Course c has modules with
+    IDs c * 1000000 + m * 100 for m = 0, 1, ..., and module M has items with IDs M + 1, M + 2, ....
+    Like Canvas, module lists carry their items inline unless a module has more than
+    inline_item_limit items, support ETags, and report rate-limit headers.
+    """
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.module_counts = {course_id: args.modules for course_id in self.get_course_ids()}
+        self.request_counts: Dict[str, int] = {}
+        self.attempts_by_url: Dict[str, int] = {}
+        self.bytes_sent = 0
+
+    def get_course_ids(self) -> List[int]:
+        return list(range(1, self.args.courses + 1))
+
+    def get_module_ids(self, course_id: int) -> List[int]:
+        """
+        Returns the IDs of all modules and module items of the given course.
+        """
+
+        module_ids = []
+
+        for module_index in range(self.module_counts[course_id]):
+            module_id = course_id * 1000000 + module_index * 100
+            module_ids.append(module_id)
+            module_ids.extend(module_id + 1 + item_index for item_index in range(self.args.items))
+
+        return module_ids
+
+    def publish_new_modules(self) -> List[int]:
+        """
+        Adds one module to a random change_rate fraction of the courses. Returns the IDs of the
+        courses that changed.
+        """
+
+        changed = []
+
+        for course_id in self.get_course_ids():
+            if self.random.random() < self.args.change_rate:
+                self.module_counts[course_id] += 1
+                changed.append(course_id)
+
+        return changed
+
+    def _get_item(self, course_id: int, module_id: int, item_index: int) -> Dict[str, Any]:
+        item_id = module_id + 1 + item_index
+        return {"id": item_id, "module_id": module_id, "title": f"Item {item_id}", "type": "Page",
+                "html_url": f"https://canvas.example.com/courses/{course_id}/modules/items/{item_id}"}
+
+    def _get_module(self, course_id: int, module_index: int, include_items: bool) -> Dict[str, Any]:
+        module_id = course_id * 1000000 + module_index * 100
+        module = {"id": module_id, "name": f"Module {module_id}", "position": module_index + 1,
+                  "items_count": self.args.items}
+
+        if include_items and self.args.items <= self.args.inline_item_limit:
+            module["items"] = [self._get_item(course_id, module_id, i) for i in range(self.args.items)]
+
+        return module
+
+    async def _respond(self, request: web.Request, kind: str, body: Any,
+                       next_url: Optional[str] = None) -> web.Response:
+        self.request_counts[kind] = self.request_counts.get(kind, 0) + 1
+        await asyncio.sleep(self.args.latency)
+
+        # Whether a request fails depends only on its URL and how often the URL was requested
+        # before, so failures are reproducible no matter in which order concurrent requests arrive.
+        url = str(request.rel_url)
+        self.attempts_by_url[url] = self.attempts_by_url.get(url, 0) + 1
+
+        if random.Random(f"{self.args.seed}:{url}:{self.attempts_by_url[url]}").random() < self.args.failure_rate:
+            self.request_counts["failed"] = self.request_counts.get("failed", 0) + 1
+            return web.Response(status=500, text="Injected failure")
+
+        text = json.dumps(body)
+        headers = {"ETag": f'W/"{hashlib.md5(text.encode()).hexdigest()}"',
+                   "X-Rate-Limit-Remaining": "700.0", "X-Request-Cost": "1.0"}
+
+        if next_url:
+            headers["Link"] = f'<{next_url}>; rel="next"'
+
+        if request.headers.get("If-None-Match") == headers["ETag"]:
+            self.request_counts["not_modified"] = self.request_counts.get("not_modified", 0) + 1
+            return web.Response(status=304, headers=headers)
+
+        self.bytes_sent += len(text)
+        return web.Response(text=text, content_type="application/json", headers=headers)
+
+    async def get_course(self, request: web.Request) -> web.Response:
+        course_id = int(request.match_info["course_id"])
+        return await self._respond(request, "course", {"id": course_id, "name": f"Course {course_id}"})
+
+    async def get_modules(self, request: web.Request) -> web.Response:
+        course_id = int(request.match_info["course_id"])
+        page = int(request.query.get("page", "1"))
+        per_page = int(request.query.get("per_page", "10"))
+        include_items = request.query.get("include[]") == "items"
+        module_count = self.module_counts[course_id]
+
+        body = [self._get_module(course_id, i, include_items)
+                for i in range((page - 1) * per_page, min(page * per_page, module_count))]
+        next_url = None
+
+        if page * per_page < module_count:
+            next_url = str(request.rel_url.update_query(page=page + 1))
+
+        return await self._respond(request, "modules", body, next_url)
+
+    async def get_module_items(self, request: web.Request) -> web.Response:
+        course_id = int(request.match_info["course_id"])
+        module_id = int(request.match_info["module_id"])
+        body = [self._get_item(course_id, module_id, i) for i in range(self.args.items)]
+        return await self._respond(request, "items", body)
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/api/v1/courses/{course_id}", self.get_course)
+        app.router.add_get("/api/v1/courses/{course_id}/modules", self.get_modules)
+        app.router.add_get("/api/v1/courses/{course_id}/modules/{module_id}/items", self.get_module_items)
+        return app
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int):
+        self.id = channel_id
+
+
+class FakeDiscord:
+    """
+    An in-memory Discord that stands in for both the bot (get_channel) and its HTTP client
+    (request). It counts the messages and embeds it receives.
+    """
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.channels = {channel_id: FakeChannel(channel_id) for channel_id in range(1, args.channels + 1)}
+        self.http = self
+        self.message_count = 0
+        self.embed_count = 0
+
+    def get_channel(self, channel_id: int) -> Optional[FakeChannel]:
+        return self.channels.get(channel_id)
+
+    async def record(self, channel_id: int, embed_count: int):
+        await asyncio.sleep(self.args.discord_latency)
+        self.message_count += 1
+        self.embed_count += embed_count
+
+    async def request(self, route, json=None):
+        await self.record(route.channel_id, len(json.get("embeds", [])))
+
+
+def get_git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    # periodic_tasks creates its storage when imported, so the data directory must be set first.
+    data_directory = tempfile.mkdtemp(prefix="canvas_tracker_benchmark_")
+    os.environ["DATA_DIRECTORY"] = data_directory
+    os.environ["STORAGE_BACKEND"] = args.storage
+    # Every fake host is served by the same fake Canvas, but gets its own client and lane.
+    hosts = [f"canvas{index}.example.com" for index in range(max(1, args.hosts))]
+    os.environ["CANVAS_HOSTS"] = ",".join(hosts)
+
+    import delivery
+    import periodic_tasks
+    from canvas_client import CanvasClient
+    from canvas_hosts import CourseKey
+
+    fake_canvas = FakeCanvas(args)
+    fake_discord = FakeDiscord(args)
+    runner = web.AppRunner(fake_canvas.create_app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    periodic_tasks.CANVAS_INSTANCES = {host: CanvasClient(f"http://127.0.0.1:{port}/", "benchmark") for host in hosts}
+    periodic_tasks.DISPATCHER = delivery.DeliveryDispatcher(periodic_tasks.STORAGE, args.discord_rate)
+    periodic_tasks.DISPATCHER.set_http_client(fake_discord.http)
+
+    # Courses are spread over the hosts in turn. Every channel tracks watchers_per_channel random
+    # courses, and every course starts out with all of its modules known.
+    rng = random.Random(args.seed)
+    course_keys = [CourseKey(hosts[index % len(hosts)], course_id)
+                   for index, course_id in enumerate(fake_canvas.get_course_ids())]
+
+    for course_key in course_keys:
+        periodic_tasks.STORAGE.set_course_name(course_key, f"Course {course_key.course_id}")
+        periodic_tasks.STORAGE.add_module_ids(course_key, fake_canvas.get_module_ids(course_key.course_id))
+
+    for channel_id in fake_discord.channels:
+        for course_key in rng.sample(course_keys, min(args.watchers_per_channel, len(course_keys))):
+            periodic_tasks.WATCHERS.add(course_key, channel_id)
+
+    periodic_tasks.WATCHERS.flush()
+
+    if args.trace_memory:
+        tracemalloc.start()
+
+    def is_missed(course_key: CourseKey) -> bool:
+        # Every module of a watched course must be known after a sweep, or a new one was missed.
+        known_module_ids = periodic_tasks.STORAGE.get_module_ids(course_key)
+        return bool(periodic_tasks.WATCHERS.get_channels(course_key)) and not all(
+            module_id in known_module_ids for module_id in fake_canvas.get_module_ids(course_key.course_id))
+
+    sweeps = []
+
+    for sweep in range(args.sweeps):
+        changed_course_ids = fake_canvas.publish_new_modules() if sweep > 0 else []
+        requests_before = dict(fake_canvas.request_counts)
+        messages_before = fake_discord.message_count
+
+        start = time.perf_counter()
+        await periodic_tasks.check_canvas(fake_discord)
+        poll_time = time.perf_counter() - start
+        await periodic_tasks.DISPATCHER.join()
+        total_time = time.perf_counter() - start
+
+        missed_courses = [course_key for course_key in course_keys
+                          if course_key.course_id in changed_course_ids and is_missed(course_key)]
+
+        sweeps.append({
+            "changed_courses": len(changed_course_ids),
+            "missed_courses": len(missed_courses),
+            "poll_seconds": round(poll_time, 3),
+            "total_seconds": round(total_time, 3),
+            "requests": {kind: count - requests_before.get(kind, 0)
+                         for kind, count in fake_canvas.request_counts.items()},
+            "messages_sent": fake_discord.message_count - messages_before
+        })
+
+    results = {
+        "revision": get_git_revision(),
+        "config": vars(args),
+        "sweeps": sweeps,
+        "total_requests": sum(count for kind, count in fake_canvas.request_counts.items()
+                              if kind not in ("failed", "not_modified")),
+        "bytes_sent": fake_canvas.bytes_sent,
+        "messages_sent": fake_discord.message_count,
+        "embeds_sent": fake_discord.embed_count,
+        "missed_courses": sum(sweep["missed_courses"] for sweep in sweeps),
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+    if args.trace_memory:
+        results["peak_traced_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    for client in periodic_tasks.CANVAS_INSTANCES.values():
+        await client.close()
+
+    await runner.cleanup()
+    periodic_tasks.STORAGE.close()
+    shutil.rmtree(data_directory, ignore_errors=True)
+    return results
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any]):
+    """
+    Prints how the headline numbers of results differ from those of a previous run.
+    """
+
+    def print_change(name: str, new: float, old: float):
+        change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+        print(f"{name}: {old} -> {new} ({change})", file=sys.stderr)
+
+    for index, (new, old) in enumerate(zip(results["sweeps"], baseline["sweeps"])):
+        print_change(f"sweep {index} total seconds", new["total_seconds"], old["total_seconds"])
+
+    for key in ("total_requests", "bytes_sent", "messages_sent", "peak_rss_kb"):
+        print_change(key, results[key], baseline[key])
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the polling pipeline against fake Canvas and Discord.")
+    parser.add_argument("--courses", type=int, default=100)
+    parser.add_argument("--modules", type=int, default=50, help="modules per course")
+    parser.add_argument("--items", type=int, default=4, help="items per module")
+    parser.add_argument("--inline-item-limit", type=int, default=10,
+                        help="modules with more items than this do not include them in the module list")
+    parser.add_argument("--channels", type=int, default=500)
+    parser.add_argument("--watchers-per-channel", type=int, default=3)
+    parser.add_argument("--sweeps", type=int, default=3)
+    parser.add_argument("--change-rate", type=float, default=0.1,
+                        help="fraction of courses that get a new module before each sweep after the first")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every Canvas response")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of Canvas requests that fail")
+    parser.add_argument("--discord-latency", type=float, default=0.01, help="seconds taken by every Discord send")
+    parser.add_argument("--discord-rate", type=float, default=1000, help="Discord messages per second")
+    parser.add_argument("--storage", choices=("sqlite", "files"), default="sqlite")
+    parser.add_argument("--hosts", type=int, default=1, help="Canvas hosts the courses are spread over")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="also report peak Python memory via tracemalloc (slow)")
+    parser.add_argument("--output", help="file to write the results to")
+    parser.add_argument("--compare", help="results file of a previous run to compare against")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    output, compare_path = args.output, args.compare
+    del args.output, args.compare
+
+    # The bot's log lines go to stderr so that stdout only contains the results.
+    with contextlib.redirect_stdout(sys.stderr):
+        results = asyncio.get_event_loop().run_until_complete(run_benchmark(args))
+
+    print(json.dumps(results, indent=2))
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if compare_path:
+        with open(compare_path, 'r') as f:
+            compare(results, json.load(f))
+
+    # Courses can only be missed because of injected failures, which are retried in the next sweep.
+    if results["missed_courses"] and not args.failure_rate:
+        print(f"[Error]: New modules of {results['missed_courses']} changed courses were missed", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,340 @@
+import json
+import os
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional
+from urllib.parse import urlencode
+
+import aiohttp
+
+from canvas_throttle import CanvasThrottle
+from response_cache import ResponseCache
+
+# Seconds allowed for a whole Canvas request, and for opening its connection
+CANVAS_TIMEOUT = float(os.getenv("CANVAS_TIMEOUT", "30"))
+CANVAS_CONNECT_TIMEOUT = float(os.getenv("CANVAS_CONNECT_TIMEOUT", "10"))
+# Maximum number of open connections kept in the shared connection pool
+CANVAS_MAX_CONNECTIONS = int(os.getenv("CANVAS_MAX_CONNECTIONS", "20"))
+# Number of results requested per page from paginated endpoints
+PER_PAGE = 100
+# Number of times a throttled request is retried once the rate-limit budget has refilled
+MAX_THROTTLED_RETRIES = 3
+
+# Kinds of ModuleRecord
+MODULE = "module"
+MODULE_ITEM = "module_item"
+
+
+class CanvasException(Exception):
+    pass
+
+
+class BadRequest(CanvasException):
+    pass
+
+
+class InvalidAccessToken(CanvasException):
+    pass
+
+
+class Unauthorized(CanvasException):
+    pass
+
+
+class Forbidden(CanvasException):
+    pass
+
+
+class ResourceDoesNotExist(CanvasException):
+    pass
+
+
+class RateLimitExceeded(CanvasException):
+    pass
+
+
+class NotModified(CanvasException):
+    """
+    Raised instead of returning anything when none of the pages of a conditional request changed.
+    """
+
+    pass
+
+
+class CanvasObject:
+    """
+    A Canvas API object. Every attribute of the JSON response becomes an attribute of the object,
+    in the same way that canvasapi builds its objects.
+    """
+
+    def __init__(self, attributes: Dict[str, Any]):
+        self.__dict__.update(attributes)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(id={getattr(self, 'id', None)})"
+
+
+class Course(CanvasObject):
+    pass
+
+
+class ModuleRecord:
+    """
+    A module or module item, slimmed down to the fields needed to announce it. Canvas objects for
+    modules carry dozens of attributes (and, for modules, all of their items), so a course's
+    modules are turned into these records as soon as each page arrives.
+
+    The name is a module's name or a module item's title. Modules have no html_url.
+    """
+
+    __slots__ = ("id", "kind", "name", "html_url")
+
+    def __init__(self, id: int, kind: str, name: str, html_url: Optional[str] = None):
+        self.id = id
+        self.kind = kind
+        self.name = name
+        self.html_url = html_url
+
+    @staticmethod
+    def from_module(module: Dict[str, Any]) -> "ModuleRecord":
+        return ModuleRecord(module["id"], MODULE, module.get("name", ""), module.get("html_url"))
+
+    @staticmethod
+    def from_module_item(item: Dict[str, Any]) -> "ModuleRecord":
+        return ModuleRecord(item["id"], MODULE_ITEM, item.get("title", ""), item.get("html_url"))
+
+    def __repr__(self):
+        return f"ModuleRecord(id={self.id}, kind={self.kind})"
+
+
+def has_complete_items(module: Dict[str, Any]) -> bool:
+    """
+    Returns True if the given module's items were included inline and none were left out.
+    """
+
+    items = module.get("items")
+    return items is not None and len(items) >= module.get("items_count", len(items))
+
+
+class CanvasClient:
+    """
+    An asynchronous Canvas API client. All requests go through a single keep-alive HTTP session
+    whose connection pool is shared by every caller, so the Discord event loop is never blocked
+    on Canvas. All requests are also paced by one CanvasThrottle, so that together they stay
+    within the access token's rate-limit budget.
+
+    The session is created lazily because it must be bound to the running event loop.
+    """
+
+    def __init__(self, base_url: str, access_token: str):
+        self.base_url = base_url.rstrip("/")
+        self.access_token = access_token
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.throttle = CanvasThrottle()
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=CANVAS_MAX_CONNECTIONS),
+                timeout=aiohttp.ClientTimeout(total=CANVAS_TIMEOUT, connect=CANVAS_CONNECT_TIMEOUT),
+                headers={"Authorization": f"Bearer {self.access_token}"}
+            )
+
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def _get_url(self, endpoint: str) -> str:
+        return f"{self.base_url}/api/v1/{endpoint.lstrip('/')}"
+
+    @staticmethod
+    async def _is_throttled(response: aiohttp.ClientResponse) -> bool:
+        """
+        Returns True if Canvas refused the request because the rate-limit budget is exhausted.
+        Canvas reports this as a 403, which must not be mistaken for a real access error.
+        """
+
+        if response.status == 429:
+            return True
+
+        return response.status == 403 and "Rate Limit Exceeded" in await response.text()
+
+    @asynccontextmanager
+    async def _get(self, url: str, **kwargs) -> AsyncIterator[aiohttp.ClientResponse]:
+        """
+        Sends a GET request through the throttle and yields the response. Throttled requests are
+        retried after the budget has refilled, up to MAX_THROTTLED_RETRIES times.
+        """
+
+        for attempt in range(MAX_THROTTLED_RETRIES + 1):
+            await self.throttle.acquire()
+
+            try:
+                async with self._get_session().get(url, **kwargs) as response:
+                    self.throttle.update(response.headers)
+
+                    if not await self._is_throttled(response):
+                        yield response
+                        return
+
+                    self.throttle.record_throttled()
+
+                    if attempt == MAX_THROTTLED_RETRIES:
+                        raise RateLimitExceeded(await response.text())
+            finally:
+                self.throttle.release()
+
+    @staticmethod
+    async def _raise_for_status(response: aiohttp.ClientResponse):
+        """
+        Raises the CanvasException matching the response's status code, if the status code
+        indicates an error.
+        """
+
+        if response.status < 400:
+            return
+
+        message = await response.text()
+
+        if response.status == 400:
+            raise BadRequest(message)
+        elif response.status == 401:
+            if "WWW-Authenticate" in response.headers:
+                raise InvalidAccessToken(message)
+            raise Unauthorized(message)
+        elif response.status == 403:
+            raise Forbidden(message)
+        elif response.status == 404:
+            raise ResourceDoesNotExist(message)
+        elif response.status == 429:
+            raise RateLimitExceeded(message)
+        else:
+            raise CanvasException(f"Canvas returned status {response.status}: {message}")
+
+    async def request(self, endpoint: str, params: Optional[Dict[str, Any]] = None) -> Any:
+        """
+        Sends a GET request to the given API endpoint and returns the decoded JSON body.
+        """
+
+        async with self._get(self._get_url(endpoint), params=params) as response:
+            await self._raise_for_status(response)
+            return await response.json()
+
+    async def paginate(self, endpoint: str, params: Optional[Dict[str, Any]] = None) -> AsyncIterator[Any]:
+        """
+        Yields every element of a paginated API endpoint, following the "next" links that Canvas
+        puts in each response's Link header.
+        """
+
+        url = self._get_url(endpoint)
+        params = dict(params or {}, per_page=PER_PAGE)
+
+        while url:
+            async with self._get(url, params=params) as response:
+                await self._raise_for_status(response)
+                page = await response.json()
+                next_link = response.links.get("next")
+
+            for element in page:
+                yield element
+
+            # The next link already contains all query parameters.
+            url = str(next_link["url"]) if next_link else None
+            params = None
+
+    @staticmethod
+    def _get_next_url(response: aiohttp.ClientResponse, cached_next_url: Optional[str]) -> Optional[str]:
+        """
+        Returns the URL of the page after the given response. An unchanged page can be followed by
+        a new page, e.g. when a new module no longer fits on the last page, so the response's Link
+        header is used whenever Canvas sends one. The cached URL is only used without it.
+        """
+
+        if "Link" not in response.headers:
+            return cached_next_url
+
+        next_link = response.links.get("next")
+        return str(next_link["url"]) if next_link else None
+
+    async def paginate_if_modified(self, endpoint: str, params: Dict[str, Any],
+                                   cache: ResponseCache) -> AsyncIterator[Any]:
+        """
+        Yields every element of a paginated API endpoint, or raises NotModified if Canvas reports
+        that none of the pages have changed since they were stored in the given cache.
+
+        Pages are requested with the validators stored in the cache until one of them has changed.
+        The unchanged pages before it are then downloaded again without validators, because their
+        bodies are not cached, and so are all pages after it. The elements are yielded in order as
+        the pages arrive. The cache is updated in memory once every page has been yielded, but not
+        saved.
+        """
+
+        url = f"{self._get_url(endpoint)}?{urlencode(dict(params, per_page=PER_PAGE))}"
+        unchanged_urls = []
+        entries = {}
+
+        while url:
+            async with self._get(url, headers={} if entries else cache.get_validators(url)) as response:
+                if response.status == 304:
+                    unchanged_urls.append(url)
+                    url = self._get_next_url(response, cache.get_next_url(url))
+                    continue
+
+                await self._raise_for_status(response)
+                body = await response.read()
+                next_link = response.links.get("next")
+                next_url = str(next_link["url"]) if next_link else None
+
+            for unchanged_url in unchanged_urls:
+                async with self._get(unchanged_url) as unchanged_response:
+                    await self._raise_for_status(unchanged_response)
+                    unchanged_body = await unchanged_response.read()
+                    entries[unchanged_url] = ResponseCache.make_page_entry(
+                        unchanged_response.headers, self._get_next_url(unchanged_response, None),
+                        len(unchanged_body))
+
+                for element in json.loads(unchanged_body):
+                    yield element
+
+            unchanged_urls = []
+            entries[url] = ResponseCache.make_page_entry(response.headers, next_url, len(body))
+
+            for element in json.loads(body):
+                yield element
+
+            url = next_url
+
+        if not entries:
+            raise NotModified()
+
+        cache.replace_pages(entries)
+
+    async def get_course(self, course_id: int) -> Course:
+        return Course(await self.request(f"courses/{course_id}"))
+
+    async def get_active_courses(self) -> List[Course]:
+        """
+        Returns every course in which the access token's user has an active enrollment. Courses
+        the user can no longer access, which Canvas lists without a name, are left out.
+        """
+
+        return [Course(course) async for course in self.paginate("courses", {"enrollment_state": "active"})
+                if "name" in course]
+
+    def get_modules(self, course_id: int, cache: Optional[ResponseCache] = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Yields all modules of the given course, with each module's items embedded. Canvas leaves
+        out the items of large modules, so callers must check each module with has_complete_items.
+
+        If a response cache is given, the module list is requested conditionally, and NotModified
+        is raised if it has not changed.
+        """
+
+        endpoint = f"courses/{course_id}/modules"
+        params = {"include[]": "items"}
+        return self.paginate(endpoint, params) if cache is None else self.paginate_if_modified(endpoint, params, cache)
+
+    def get_module_items(self, course_id: int, module_id: int) -> AsyncIterator[Dict[str, Any]]:
+        return self.paginate(f"courses/{course_id}/modules/{module_id}/items")
+
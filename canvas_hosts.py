@@ -0,0 +1,57 @@
+import os
+import re
+from typing import Dict, List, NamedTuple, Optional
+
+# Comma-separated host names of the Canvas instances courses can be tracked on. The first one is
+# the default host, used when a command does not name one.
+CANVAS_HOSTS: List[str] = [host.strip().lower() for host in os.getenv("CANVAS_HOSTS", "canvas.ubc.ca").split(",")
+                           if host.strip()]
+DEFAULT_CANVAS_HOST = CANVAS_HOSTS[0]
+
+
+class CourseKey(NamedTuple):
+    """
+    Identifies a course across Canvas instances, since course IDs are only unique within one
+    instance.
+    """
+
+    host: str
+    course_id: int
+
+    def __str__(self) -> str:
+        return f"{self.host}/{self.course_id}"
+
+
+def get_token_variable(host: str) -> str:
+    """
+    Returns the name of the environment variable holding the access token for the given host,
+    e.g. CANVAS_TOKEN_CANVAS_UBC_CA for canvas.ubc.ca.
+    """
+
+    return f"CANVAS_TOKEN_{re.sub(r'[^A-Za-z0-9]', '_', host).upper()}"
+
+
+def get_token(host: str) -> Optional[str]:
+    """
+    Returns the access token for the given host. The default host also accepts CANVAS_TOKEN, which
+    is what the bot used before it supported several hosts.
+    """
+
+    token = os.getenv(get_token_variable(host))
+
+    if not token and host == DEFAULT_CANVAS_HOST:
+        token = os.getenv("CANVAS_TOKEN")
+
+    return token
+
+
+def get_tokens() -> Dict[str, Optional[str]]:
+    return {host: get_token(host) for host in CANVAS_HOSTS}
+
+
+def normalize_host(host: str) -> str:
+    """
+    Accepts a host given by a user, with or without a scheme and trailing slash.
+    """
+
+    return re.sub(r'^https?://', '', host.strip().lower()).rstrip('/')
@@ -0,0 +1,100 @@
+import asyncio
+import os
+import time
+from typing import Mapping
+
+# Canvas gives each access token a bucket of this many units. Every request adds its cost to
+# the bucket, and the bucket leaks LEAK_RATE units per second. Canvas starts throttling once the
+# bucket is full, i.e. once X-Rate-Limit-Remaining reaches 0.
+RATE_LIMIT_CAPACITY = float(os.getenv("CANVAS_RATE_LIMIT_CAPACITY", "700"))
+LEAK_RATE = float(os.getenv("CANVAS_RATE_LIMIT_LEAK_RATE", "10"))
+# Canvas adds this cost to the bucket for every request still in flight
+PREFLIGHT_COST = 50
+# Units of the budget we never spend, to absorb estimation errors
+SAFETY_MARGIN = float(os.getenv("CANVAS_RATE_LIMIT_SAFETY_MARGIN", "100"))
+# Number of processes making requests with the same access tokens, which split each token's budget
+# equally. By default, these are the bot and the polling workers it starts (see sharding.py).
+RATE_LIMIT_SHARES = max(1, int(os.getenv("CANVAS_RATE_LIMIT_SHARES", str(int(os.getenv("POLLING_WORKERS", "0")) + 1))))
+
+
+class CanvasThrottle:
+    """
+    Paces all requests made with one Canvas access token so that they never exhaust the token's
+    rate-limit budget.
+
+    The throttle keeps an estimate of the remaining budget. The estimate is reset from
+    X-Rate-Limit-Remaining on every response and refills at LEAK_RATE in between. Before a
+    request starts, the throttle waits until the estimate covers the request's expected cost (the
+    average X-Request-Cost seen so far), the preflight cost of every request in flight, and
+    SAFETY_MARGIN.
+
+    Canvas keeps one bucket per token, however many processes use the token, and every process
+    only knows about its own requests in flight. Each process therefore only spends its share of
+    the budget: the capacity, leak rate, safety margin and reported remaining units are divided
+    by the number of shares.
+    """
+
+    def __init__(self, shares: int = RATE_LIMIT_SHARES):
+        self.shares = shares
+        self.capacity = RATE_LIMIT_CAPACITY / shares
+        self.leak_rate = LEAK_RATE / shares
+        self.safety_margin = SAFETY_MARGIN / shares
+        self.remaining = self.capacity
+        self.updated_at = time.monotonic()
+        self.in_flight = 0
+        self.average_cost = 1.0
+        self.throttled_count = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.remaining = min(self.capacity, self.remaining + (now - self.updated_at) * self.leak_rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        """
+        Waits until the budget allows another request to start. Every call must be followed by
+        a call to release.
+        """
+
+        while True:
+            self._refill()
+            needed = self.safety_margin + (self.in_flight + 1) * PREFLIGHT_COST + self.average_cost
+
+            # A share too small for even one request still lets one request at a time through once it is full.
+            if self.in_flight == 0:
+                needed = min(needed, self.capacity)
+
+            if self.remaining >= needed:
+                self.in_flight += 1
+                return
+
+            await asyncio.sleep((needed - self.remaining) / self.leak_rate)
+
+    def release(self):
+        self.in_flight -= 1
+
+    def update(self, headers: Mapping[str, str]):
+        """
+        Updates the budget estimate from the rate-limit headers of a Canvas response.
+        """
+
+        remaining = headers.get("X-Rate-Limit-Remaining")
+        cost = headers.get("X-Request-Cost")
+
+        if remaining is not None:
+            # Requests still in flight have their preflight cost included in the reported value.
+            share = float(remaining) / self.shares + (self.in_flight - 1) * PREFLIGHT_COST
+            self.remaining = min(self.capacity, share)
+            self.updated_at = time.monotonic()
+
+        if cost is not None:
+            self.average_cost = 0.9 * self.average_cost + 0.1 * float(cost)
+
+    def record_throttled(self):
+        """
+        Records that Canvas throttled a request, which means that the budget is empty.
+        """
+
+        self.remaining = 0.0
+        self.updated_at = time.monotonic()
+        self.throttled_count += 1
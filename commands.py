@@ -1,17 +1,45 @@
-import os
-import shutil
+import asyncio
 import traceback
-from typing import List
+from typing import Dict, List
 
-import canvasapi
-import canvasapi.exceptions
-import discord
 from discord.ext import commands
 from discord.ext.commands import Bot
 
+import canvas_client
+import canvas_hosts
+import metrics
 import periodic_tasks
-import util
-from util import CanvasUtil
+import scheduler
+from canvas_hosts import CourseKey
+from loop_watchdog import WATCHDOG
+from metrics import METRICS
+
+# Number of courses listed by !stats as the slowest to fetch
+STATS_SLOWEST_COURSES = 5
+# Seconds !track discover waits for the user to choose the courses to track
+DISCOVER_REPLY_TIMEOUT = 120
+# Discord rejects messages longer than this many characters
+MAX_MESSAGE_LENGTH = 2000
+
+TRACK_USAGE = "Usage: `!track <enable | disable> <course_id> [course_id ...] [host]` or `!track discover [host]`"
+
+
+async def send_lines(ctx, lines: List[str]):
+    """
+    Sends the given lines in as few messages as Discord's message length allows.
+    """
+
+    message = ""
+
+    for line in lines:
+        if message and len(message) + 1 + len(line) > MAX_MESSAGE_LENGTH:
+            await ctx.send(message)
+            message = ""
+
+        message = f"{message}\n{line}" if message else line
+
+    if message:
+        await ctx.send(message)
 
 
 class BotManagement(commands.Cog):
@@ -28,8 +56,9 @@ class BotManagement(commands.Cog):
         Reload the bot and its extensions.
         """
         
-        self.bot.reload_extension("commands")
+        # periodic_tasks is reloaded first so that the reloaded commands module uses its new storage.
         self.bot.reload_extension("periodic_tasks")
+        self.bot.reload_extension("commands")
         await ctx.send("Bot reloaded!")
 
     @commands.command(hidden=True)
@@ -43,8 +72,44 @@ class BotManagement(commands.Cog):
         """
 
         await ctx.send("Shutting down. Goodbye.")
+        periodic_tasks.WATCHERS.flush()
         await self.bot.close()
 
+    @commands.command(hidden=True)
+    @commands.has_permissions(administrator=True)
+    @commands.guild_only()
+    async def stats(self, ctx):
+        """
+        `!stats`
+
+        Show how long each phase of polling Canvas takes, and which courses are slowest to fetch.
+        """
+
+        summary = METRICS.get_phase_summary()
+
+        if not summary:
+            await ctx.send("No courses have been polled yet.")
+            return
+
+        lines = ["```", f"{'phase':<14}{'count':>8}{'avg':>9}{'p95':>9}{'max':>9}"]
+
+        for phase in (metrics.COURSE_LOOKUP, metrics.CANVAS_FETCH, metrics.DIFF, metrics.EMBED_BUILD,
+                      metrics.DISCORD_SEND, metrics.PERSISTENCE):
+            histogram = summary.get(phase)
+
+            if histogram is not None and histogram.count:
+                lines.append(f"{phase:<14}{histogram.count:>8}{histogram.total / histogram.count:>8.3f}s"
+                             f"{histogram.get_quantile(0.95):>8.3f}s{histogram.max:>8.3f}s")
+
+        lines.append("```")
+        slowest = METRICS.get_slowest_courses(metrics.CANVAS_FETCH, STATS_SLOWEST_COURSES)
+
+        if slowest:
+            lines.append("Slowest courses to fetch:")
+            lines.extend(f"{course}: {average:.3f}s on average" for course, average in slowest)
+
+        await ctx.send("\n".join(lines))
+
     @commands.Cog.listener()
     async def on_command_error(self, ctx, error):
         if isinstance(error, commands.errors.MissingPermissions):
@@ -67,173 +132,225 @@ class Main(commands.Cog):
     @commands.guild_only()
     async def track(self, ctx, *args):
         """
-        `!track <enable | disable> <course_id>`
+        `!track <enable | disable> <course_id> [course_id ...] [host]`
+        `!track discover [host]`
 
         Configure the current text channel to receive an update when a new course module is published on Canvas.
+        Several courses can be enabled or disabled at once. `discover` lists the courses you are enrolled in and
+        lets you choose which of them to track. Courses are looked up on the given Canvas host, or on the default
+        host if none is given.
         """
 
-        if len(args) != 2:
-            await ctx.send("Usage: `!track <enable | disable> <course_id>`")
-        elif args[0] != "enable" and args[0] != "disable":
-            await ctx.send("Usage: `!track <enable | disable> <course_id>`")
+        args = list(args)
+        host = canvas_hosts.DEFAULT_CANVAS_HOST
+
+        if len(args) >= 2 and not args[-1].isdigit():
+            host = canvas_hosts.normalize_host(args.pop())
+
+        client = periodic_tasks.CANVAS_INSTANCES.get(host)
+        course_ids = args[1:]
+        # Disabling does not look anything up on Canvas, so courses can still be untracked after their
+        # host's token, or the host itself, has been removed.
+        disabling = bool(args) and args[0] == "disable"
+
+        if not args or args[0] not in ("enable", "disable", "discover") or (args[0] == "discover") != (not course_ids):
+            await ctx.send(TRACK_USAGE)
+        elif host not in canvas_hosts.CANVAS_HOSTS and not (disabling
+                                                            and periodic_tasks.WATCHERS.get_course_keys(host)):
+            await ctx.send(f"Unknown Canvas host {host}. Available hosts: {', '.join(canvas_hosts.CANVAS_HOSTS)}")
+        elif not client and not disabling:
+            await ctx.send(f"Error: No Canvas instance exists for {host}!")
+        elif args[0] == "discover":
+            await self.discover_courses(ctx, client, host)
+        elif not all(course_id.isdigit() for course_id in course_ids):
+            await ctx.send("The given course could not be found.")
         else:
-            try:
-                course = periodic_tasks.CANVAS_INSTANCE.get_course(args[1])
-            except canvasapi.exceptions.ResourceDoesNotExist:
-                await ctx.send("The given course could not be found.")
-                return
-            except canvasapi.exceptions.Unauthorized:
-                await ctx.send("Unauthorized request.")
-                return
-            except canvasapi.exceptions.InvalidAccessToken:
+            course_keys = list(dict.fromkeys(CourseKey(host, int(course_id)) for course_id in course_ids))
+
+            if args[0] == "enable":
+                await self.enable_courses(ctx, client, course_keys)
+            else:
+                await self.disable_courses(ctx, course_keys)
+
+    async def enable_courses(self, ctx, client: canvas_client.CanvasClient, course_keys: List[CourseKey]):
+        courses = await asyncio.gather(*(client.get_course(course_key.course_id) for course_key in course_keys),
+                                       return_exceptions=True)
+        course_names = {}
+        lines = []
+
+        for course_key, course in zip(course_keys, courses):
+            if isinstance(course, canvas_client.ResourceDoesNotExist):
+                lines.append(f"Course {course_key.course_id} could not be found.")
+            elif isinstance(course, (canvas_client.Unauthorized, canvas_client.Forbidden)):
+                lines.append(f"Unauthorized request for course {course_key.course_id}.")
+            elif isinstance(course, canvas_client.InvalidAccessToken):
                 await ctx.send("Your Canvas token is invalid.")
                 return
+            elif isinstance(course, canvas_client.RateLimitExceeded):
+                lines.append(f"Course {course_key.course_id} was skipped because Canvas is receiving too many "
+                             f"requests. Please try again in a minute.")
+            elif isinstance(course, Exception):
+                # One course failing, e.g. because Canvas timed out, must not keep the others from being tracked.
+                print(f"[Error]: Failed to look up course {course_key} for !track", flush=True)
+                print("".join(traceback.format_exception(type(course), course, course.__traceback__)), flush=True)
+                lines.append(f"Course {course_key.course_id} could not be looked up on Canvas. Please try again later.")
+            elif isinstance(course, BaseException):
+                raise course
+            else:
+                course_names[course_key] = course.name
 
-            watchers_file = CanvasUtil.get_watchers_file_path_by_course_id(args[1])
+        await self.start_tracking(ctx, course_names, lines)
 
-            if not periodic_tasks.CANVAS_INSTANCE:
-                await ctx.send("Error: No Canvas instance exists!")
-                return
+    async def disable_courses(self, ctx, course_keys: List[CourseKey]):
+        lines = []
 
-            if args[0] == "enable":
-                # The watchers file contains all the channels watching the course
-                added = await self.store_channel_in_file(ctx.channel, watchers_file)
-                CanvasUtil.store_course_name_locally(args[1], course.name)
-                modules_file = CanvasUtil.get_modules_file_path(args[1])
-                util.ensure_file_exists(modules_file)
-
-                if added:
-                    await ctx.send(f"This channel is now tracking {course.name}.")
-
-                    # We will only update the modules if modules_file is empty.
-                    if os.stat(modules_file).st_size == 0:
-                        CanvasUtil.write_modules_to_file(modules_file, CanvasUtil.get_modules(course))
-                else:
-                    await ctx.send(f"This channel is already tracking {course.name}.")
-            else:   # this is the case where args[0] is "disable"
-                deleted = await self.delete_channel_from_file(ctx.channel, watchers_file)
-
-                if os.stat(watchers_file).st_size == 0:
-                    shutil.rmtree(CanvasUtil.get_course_directory(args[1]))
-
-                if deleted:
-                    await ctx.send(f"This channel is no longer tracking {course.name}.")
-                else:
-                    await ctx.send(f"This channel is already not tracking {course.name}.")
-
-    @commands.command(hidden=True)
-    @commands.guild_only()
-    async def update_courses(self, ctx):
-        """
-        `!update_courses`
+        for course_key in course_keys:
+            # The stored name is used, since Canvas may no longer show the course to us.
+            if periodic_tasks.WATCHERS.get_channels(course_key):
+                course_name = periodic_tasks.STORAGE.get_course_name(course_key)
+            else:
+                course_name = f"course {course_key.course_id}"
 
-        Download and store the latest Canvas modules for all courses being tracked.
-        """
+            deleted = periodic_tasks.WATCHERS.remove(course_key, ctx.channel.id)
 
-        if not periodic_tasks.CANVAS_INSTANCE:
-            await ctx.send("Error: No Canvas instance exists!")
-        else:
-            await periodic_tasks.check_canvas(self.bot)
-            await ctx.send("Courses updated!")
+            if not periodic_tasks.WATCHERS.get_channels(course_key):
+                periodic_tasks.delete_course(course_key)
 
-    @commands.command()
-    @commands.guild_only()
-    async def get_tracked_courses(self, ctx):
-        """
-        `!get_tracked_courses`
+            if deleted:
+                lines.append(f"This channel is no longer tracking {course_name}.")
+            else:
+                lines.append(f"This channel is already not tracking {course_name}.")
 
-        Sends a list of all courses being tracked by this channel.
-        """
+        await send_lines(ctx, lines)
 
-        def get_courses_tracked_by_channel(channel_id: int) -> List[str]:
-            course_list = []
-            for course_dir in os.listdir(periodic_tasks.COURSES_DIRECTORY):
-                full_course_dir = f"{periodic_tasks.COURSES_DIRECTORY}/{course_dir}"
-
-                try:
-                    with open(CanvasUtil.get_course_name_file_path_by_course_dir(full_course_dir)) as f:
-                        course_name = f.readline().rstrip('\n')
-                except FileNotFoundError:
-                    course_name = "<Course name not found>"
-
-                try:
-                    with open(CanvasUtil.get_watchers_file_path_by_course_dir(full_course_dir), "r") as w:
-                        for line in w:
-                            if line == f"{channel_id}\n":
-                                # The course subfolder's name is exactly the course ID.
-                                course_list.append(f"{course_name} (ID: {course_dir})")
-                                break
-                except FileNotFoundError:
-                    continue
-
-            return course_list
+    async def discover_courses(self, ctx, client: canvas_client.CanvasClient, host: str):
+        try:
+            courses = await client.get_active_courses()
+        except canvas_client.InvalidAccessToken:
+            await ctx.send("Your Canvas token is invalid.")
+            return
+        except canvas_client.RateLimitExceeded:
+            await ctx.send("Canvas is receiving too many requests. Please try again in a minute.")
+            return
+
+        if not courses:
+            await ctx.send(f"No active courses were found on {host}.")
+            return
+
+        lines = [f"Active courses on {host}:"]
+        lines += [f"{number}. {course.name} ({course.id})" for number, course in enumerate(courses, 1)]
+        lines.append("Reply with the numbers of the courses to track, separated by spaces, or `all`.")
+        await send_lines(ctx, lines)
+
+        def is_reply(message) -> bool:
+            return (message.author == ctx.author and message.channel == ctx.channel
+                    and not message.content.startswith(ctx.prefix))
 
         try:
-            courses = get_courses_tracked_by_channel(ctx.channel.id)
-            if len(courses) == 0:
-                message = "No courses are being tracked in this channel."
-            else:
-                message = "\n".join(f"{i + 1}. {courses[i]}" for i in range(len(courses)))
-        except FileNotFoundError:   # occurs if there is no root courses directory
-            message = "No courses are being tracked in this channel."
+            reply = await self.bot.wait_for("message", check=is_reply, timeout=DISCOVER_REPLY_TIMEOUT)
+        except asyncio.TimeoutError:
+            await ctx.send("No courses were chosen in time.")
+            return
 
-        await ctx.send(message)
+        choice = reply.content.replace(",", " ").split()
+
+        if [word.lower() for word in choice] == ["all"]:
+            chosen = courses
+        elif choice and all(word.isdigit() and 1 <= int(word) <= len(courses) for word in choice):
+            chosen = [courses[int(word) - 1] for word in dict.fromkeys(choice)]
+        else:
+            await ctx.send("That is not a valid choice, so no courses were tracked.")
+            return
+
+        await self.start_tracking(ctx, {CourseKey(host, course.id): course.name for course in chosen}, [])
 
-    @staticmethod
-    async def store_channel_in_file(channel: discord.TextChannel, file_path: str):
+    async def start_tracking(self, ctx, course_names: Dict[CourseKey, str], lines: List[str]):
         """
-        Adds given text channel's id to file with given path if the channel id is 
-        not already contained in the file. Returns True if the channel id was added to the file. 
-        Returns False if the channel id was already contained in the file.
+        Tracks the given courses in the current channel and replies right away. The modules of the
+        newly tracked courses are downloaded afterwards, and courses whose modules cannot be
+        downloaded are no longer tracked.
         """
 
-        util.ensure_file_exists(file_path)
+        added = [course_key for course_key in course_names
+                 if periodic_tasks.WATCHERS.add(course_key, ctx.channel.id)]
+        periodic_tasks.STORAGE.set_course_names(course_names)
+        snapshots = periodic_tasks.start_snapshots(added, ctx.channel.id)
 
-        with open(file_path, 'a+') as f:
-            # Start reading from the beginning of the file. Note: file *writes*
-            # will happen at the end of the file no matter what.
-            f.seek(0)
+        for course_key, course_name in course_names.items():
+            if course_key in added:
+                lines.append(f"This channel is now tracking {course_name}.")
+            else:
+                lines.append(f"This channel is already tracking {course_name}.")
 
-            # The \n has to be here because:
-            # - the lines in the file include the \n character at the end
-            # - f.write(str) does not insert a new line after writing
-            id_to_add = f"{channel.id}\n"
+        await send_lines(ctx, lines)
+        failed = await snapshots
+        await send_lines(ctx, [f"The modules of {course_names[course_key]} could not be downloaded, so this channel "
+                               f"is no longer tracking it. Please try again later." for course_key in failed])
 
-            for channel_id in f:
-                if channel_id == id_to_add:
-                    return False
+    @commands.command(hidden=True)
+    @commands.guild_only()
+    async def update_courses(self, ctx, course_id=None, host=None):
+        """
+        `!update_courses [course_id] [host]`
 
-            f.write(id_to_add)
+        Download and store the latest Canvas modules for all courses being tracked, or only for the given course.
+        If the courses are already being updated, wait for that update instead of starting another one.
+        """
 
-        return True
+        host = canvas_hosts.normalize_host(host) if host is not None else canvas_hosts.DEFAULT_CANVAS_HOST
+
+        if not periodic_tasks.CANVAS_INSTANCES:
+            await ctx.send("Error: No Canvas instance exists!")
+        elif course_id is None:
+            await periodic_tasks.check_canvas(self.bot)
+            await ctx.send("Courses updated!")
+        elif host not in periodic_tasks.CANVAS_INSTANCES:
+            await ctx.send(f"Error: No Canvas instance exists for {host}!")
+        elif not course_id.isdigit() or not periodic_tasks.WATCHERS.get_channels(CourseKey(host, int(course_id))):
+            await ctx.send("The given course is not being tracked.")
+        else:
+            course_key = CourseKey(host, int(course_id))
+            outcomes = await periodic_tasks.check_canvas(self.bot, [course_key])
+            outcome = outcomes.get(course_key)
+
+            if outcome == scheduler.REMOVED:
+                await ctx.send("The given course is no longer accessible and has stopped being tracked.")
+            elif outcome in (scheduler.FAILED, scheduler.THROTTLED, None):
+                await ctx.send("The given course could not be updated. Please try again later.")
+            else:
+                await ctx.send(f"{periodic_tasks.STORAGE.get_course_name(course_key)} updated!")
 
-    @staticmethod
-    async def delete_channel_from_file(channel: discord.TextChannel, file_path: str):
+    @commands.command()
+    @commands.guild_only()
+    async def get_tracked_courses(self, ctx, host=None):
         """
-        Removes given text channel's id from file with given path if the channel id
-        is contained in the file. Returns True if the channel id was deleted from the file.
-        Returns False if the channel id could not be found in the file.
+        `!get_tracked_courses [host]`
+
+        Sends a list of all courses being tracked by this channel, or only those on the given Canvas host.
         """
 
-        util.ensure_file_exists(file_path)
+        course_keys = periodic_tasks.WATCHERS.get_courses(ctx.channel.id)
 
-        with open(file_path, 'r') as f:
-            channel_ids = f.readlines()
+        if host is not None:
+            host = canvas_hosts.normalize_host(host)
+            course_keys = [course_key for course_key in course_keys if course_key.host == host]
 
-        id_to_remove = f"{channel.id}\n"
-        id_found = False
+        if len(course_keys) == 0:
+            message = "No courses are being tracked in this channel."
+        else:
+            message = "\n".join(f"{i + 1}. {periodic_tasks.STORAGE.get_course_name(course_key)} "
+                                f"(ID: {course_key.course_id} on {course_key.host})"
+                                for i, course_key in enumerate(course_keys))
+
+        await ctx.send(message)
 
-        with open(file_path, 'w') as f:
-            for channel_id in channel_ids:
-                if channel_id != id_to_remove:
-                    f.write(channel_id)
-                else:
-                    id_found = True
 
-        return id_found
+async def label_command(ctx):
+    WATCHDOG.label_current_task(f"the command {ctx.message.content!r}")
 
 
 def setup(bot):
+    bot.before_invoke(label_command)
     bot.add_cog(Main(bot))
     print("Loaded Main cog", flush=True)
     bot.add_cog(BotManagement(bot))
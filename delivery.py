@@ -0,0 +1,290 @@
+import asyncio
+import os
+import time
+import traceback
+from collections import deque
+from typing import Deque, Dict, List, Optional, Set
+
+import aiohttp
+import discord
+from discord.http import HTTPClient, Route
+
+import metrics
+from loop_watchdog import WATCHDOG
+from metrics import METRICS
+from outbox import OutboxMessage, make_nonce
+from storage import CourseStorage
+
+# Maximum number of messages sent per second across all channels. Discord's global limit is 50
+# requests per second; we stay a little below it to leave room for commands.
+GLOBAL_MESSAGES_PER_SECOND = float(os.getenv("DISCORD_MESSAGES_PER_SECOND", "40"))
+
+# Discord allows at most this many embeds in one message, with at most MESSAGE_EMBED_CHAR_LIMIT
+# characters across all of them
+MAX_EMBEDS_PER_MESSAGE = 10
+MESSAGE_EMBED_CHAR_LIMIT = 6000
+
+# Seconds to wait before retrying a channel after Discord failed or could not be reached. The
+# delay doubles after every consecutive failure, up to MAX_DELIVERY_RETRY_DELAY.
+DELIVERY_RETRY_DELAY = float(os.getenv("DELIVERY_RETRY_DELAY", "5"))
+MAX_DELIVERY_RETRY_DELAY = float(os.getenv("MAX_DELIVERY_RETRY_DELAY", "300"))
+
+
+def pack_embeds(embeds: List[discord.Embed]) -> List[List[discord.Embed]]:
+    """
+    Groups the given embeds, in order, into as few messages as possible. Each group can be sent
+    as one message: it has at most MAX_EMBEDS_PER_MESSAGE embeds and at most
+    MESSAGE_EMBED_CHAR_LIMIT characters in total. Every embed must already be within the limits
+    of a single embed.
+    """
+
+    messages = []
+    message = []
+    message_length = 0
+
+    for embed in embeds:
+        if len(message) >= MAX_EMBEDS_PER_MESSAGE or message_length + len(embed) > MESSAGE_EMBED_CHAR_LIMIT:
+            messages.append(message)
+            message = []
+            message_length = 0
+
+        message.append(embed)
+        message_length += len(embed)
+
+    if message:
+        messages.append(message)
+
+    return messages
+
+
+class RateLimiter:
+    """
+    A token bucket that allows at most `rate` acquisitions per second, with bursts of up to
+    `rate` acquisitions.
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class DeliveryDispatcher:
+    """
+    Sends the messages in the outbox to Discord channels independently of Canvas polling.
+
+    Every channel has its own queue, drained in order by its own worker, so messages to one
+    channel never wait behind messages to another. Discord rate-limits message sends per channel
+    (the per-route bucket), so one worker per channel keeps each channel within its bucket, with
+    discord.py waiting out any remaining per-route limits. All workers share a token bucket that
+    keeps the total send rate below Discord's global rate limit.
+
+    Messages are only removed from the outbox once Discord has accepted them. If Discord fails or
+    cannot be reached, the channel is retried with exponential backoff for as long as it takes,
+    so an outage loses nothing and costs no Canvas requests. Every Discord message is sent with a
+    nonce derived from the outbox message's dedup key, which Discord uses to drop a message that
+    is sent again after a crash or reload interrupted its delivery. Discord only remembers nonces
+    for a few minutes, so a message resent later than that may still appear twice.
+    """
+
+    def __init__(self, outbox: CourseStorage, messages_per_second: float = GLOBAL_MESSAGES_PER_SECOND):
+        self.outbox = outbox
+        self.rate_limiter = RateLimiter(messages_per_second)
+        self.http: Optional[HTTPClient] = None
+        self.queues: Dict[int, Deque[OutboxMessage]] = {}
+        self.queued_keys: Set[str] = set()
+        self.workers: Dict[int, asyncio.Task] = {}
+        self.sent_count = 0
+        self.failed_count = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def set_http_client(self, http: HTTPClient):
+        self.http = http
+
+    def enqueue(self, message: OutboxMessage):
+        """
+        Queues a message that has been committed to the outbox and returns immediately. A message
+        that is already queued is ignored.
+        """
+
+        if message.dedup_key in self.queued_keys:
+            return
+
+        self.queued_keys.add(message.dedup_key)
+        self.queues.setdefault(message.channel_id, deque()).append(message)
+
+        if message.channel_id not in self.workers:
+            self.workers[message.channel_id] = asyncio.get_event_loop().create_task(self._drain(message.channel_id))
+
+    def restore(self):
+        """
+        Queues every message left in the outbox, e.g. by a restart or a Discord outage.
+        """
+
+        messages = self.outbox.get_outbox_messages()
+
+        for message in messages:
+            self.enqueue(message)
+
+        if messages:
+            print(f"Restored {len(messages)} undelivered messages from the outbox", flush=True)
+
+    def get_queue_depth(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    async def _post(self, channel_id: int, content: Optional[str], embeds: List[dict], nonce: str):
+        # Messageable.send only accepts one embed and no enforce_nonce, so we call the endpoint
+        # directly. The request still goes through discord.py's rate-limit handling.
+        route = Route("POST", "/channels/{channel_id}/messages", channel_id=channel_id)
+        await self.http.request(route, json={"content": content, "embeds": embeds, "nonce": nonce,
+                                             "enforce_nonce": True})
+
+    def _record_sent(self, message: OutboxMessage):
+        latency = time.time() - message.created_at
+        METRICS.increment("canvas_tracker_messages_sent_total")
+        METRICS.observe("canvas_tracker_delivery_latency_seconds", latency)
+        self.sent_count += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def _remove(self, queue: Deque[OutboxMessage], count: int):
+        """
+        Removes the first count messages of the given queue from the queue and from the outbox.
+        """
+
+        messages = [queue.popleft() for _ in range(count)]
+        self.outbox.delete_outbox_messages([message.dedup_key for message in messages])
+        self.queued_keys.difference_update(message.dedup_key for message in messages)
+
+    def _drop(self, queue: Deque[OutboxMessage], count: int):
+        self.failed_count += count
+        METRICS.increment("canvas_tracker_messages_failed_total", count)
+        self._remove(queue, count)
+
+    async def _send_batch(self, queue: Deque[OutboxMessage], batch: List[OutboxMessage]):
+        """
+        Sends the given messages, which are at the front of the queue, packing their remaining
+        embeds into as few Discord messages as possible, and removes them. Progress is stored after
+        every Discord message, so a failure only leaves the unsent embeds to be sent later.
+        """
+
+        if batch[0].content is not None:
+            await self.rate_limiter.acquire()
+
+            with METRICS.time_phase(metrics.DISCORD_SEND, batch[0].course_key):
+                await self._post(batch[0].channel_id, batch[0].content, [], make_nonce(batch[0].dedup_key))
+
+            self._record_sent(batch[0])
+            self._remove(queue, 1)
+            return
+
+        # Each remaining embed, along with the message it belongs to and its position in that message
+        embeds = [(message, index, embed) for message in batch
+                  for index, embed in enumerate(message.embeds) if index >= message.sent_embeds]
+        position = 0
+
+        for message_embeds in pack_embeds([discord.Embed.from_dict(embed) for _, _, embed in embeds]):
+            part = embeds[position:position + len(message_embeds)]
+            first_message, first_index, _ = part[0]
+            last_message, last_index, _ = part[-1]
+            await self.rate_limiter.acquire()
+
+            with METRICS.time_phase(metrics.DISCORD_SEND, first_message.course_key):
+                await self._post(first_message.channel_id, None, [embed for _, _, embed in part],
+                                 make_nonce(f"{first_message.dedup_key}:{first_index}"))
+
+            self._record_sent(first_message)
+            position += len(message_embeds)
+
+            # Messages whose embeds have all been sent leave the outbox; the last one may be half-sent.
+            while queue[0] is not last_message:
+                self._remove(queue, 1)
+
+            if last_index + 1 == len(last_message.embeds):
+                self._remove(queue, 1)
+            else:
+                last_message.sent_embeds = last_index + 1
+                self.outbox.set_outbox_progress(last_message)
+
+    async def _drain(self, channel_id: int):
+        queue = self.queues[channel_id]
+        WATCHDOG.label_current_task(f"delivery to channel {channel_id}")
+        consecutive_failures = 0
+
+        try:
+            while queue:
+                # Consecutive digest messages are sent together; any other message is sent on its own.
+                batch = [queue[0]]
+
+                while batch[-1].digest and len(batch) < len(queue) and queue[len(batch)].digest:
+                    batch.append(queue[len(batch)])
+
+                try:
+                    await self._send_batch(queue, batch)
+                    consecutive_failures = 0
+                except discord.NotFound:
+                    # The channel no longer exists, so nothing else queued for it can be sent.
+                    print(f"[Error]: Channel {channel_id} no longer exists; dropping its messages", flush=True)
+                    self._drop(queue, len(queue))
+                except (discord.DiscordServerError, aiohttp.ClientError, asyncio.TimeoutError, OSError):
+                    consecutive_failures += 1
+                    delay = min(MAX_DELIVERY_RETRY_DELAY, DELIVERY_RETRY_DELAY * 2 ** (consecutive_failures - 1))
+                    METRICS.increment("canvas_tracker_delivery_retries_total")
+                    print(f"[Error]: Failed to reach Discord for channel {channel_id}; retrying in {delay:g}s",
+                          flush=True)
+                    print(traceback.format_exc(), flush=True)
+                    await asyncio.sleep(delay)
+                except discord.HTTPException:
+                    # Discord refused the message itself, so sending it again would not help.
+                    print(f"[Error]: Failed to send message to channel {channel_id}; dropping it", flush=True)
+                    print(traceback.format_exc(), flush=True)
+                    self._drop(queue, sum(message.dedup_key in self.queued_keys for message in batch))
+        finally:
+            del self.workers[channel_id]
+            del self.queues[channel_id]
+
+    async def join(self):
+        """
+        Waits until every queued message has been sent or dropped.
+        """
+
+        while self.workers:
+            await asyncio.gather(*self.workers.values(), return_exceptions=True)
+
+    def report(self):
+        """
+        Logs the current queue depth and the delivery latency since the last report.
+        """
+
+        average_latency = self.total_latency / self.sent_count if self.sent_count else 0.0
+        print(f"Delivery: {self.get_queue_depth()} messages queued for {len(self.queues)} channels; "
+              f"{self.sent_count} sent, {self.failed_count} failed; latency avg {average_latency:.2f}s, "
+              f"max {self.max_latency:.2f}s", flush=True)
+
+        self.sent_count = 0
+        self.failed_count = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def close(self):
+        """
+        Stops sending. Messages that have not been sent stay in the outbox.
+        """
+
+        for worker in self.workers.values():
+            worker.cancel()
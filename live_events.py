@@ -0,0 +1,150 @@
+import asyncio
+import hmac
+import os
+import traceback
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from aiohttp import web
+
+import canvas_hosts
+import scheduler
+from canvas_hosts import DEFAULT_CANVAS_HOST, CourseKey
+from loop_watchdog import WATCHDOG
+from metrics import METRICS
+
+# Whether to receive Canvas Live Events or webhook-style events about module changes, and check a
+# course as soon as its modules change. Polling then only reconciles missed events (default: off).
+LIVE_EVENTS_ENABLED = os.getenv("LIVE_EVENTS_ENABLED", "0") == "1"
+# Address of the local HTTP endpoint receiving the events
+LIVE_EVENTS_HOST = os.getenv("LIVE_EVENTS_HOST", "127.0.0.1")
+LIVE_EVENTS_PORT = int(os.getenv("LIVE_EVENTS_PORT", "8766"))
+# Shortest interval, in seconds, between two scheduled polls of a course while live events are
+# enabled. Scheduled polls then only catch changes whose events were lost.
+RECONCILIATION_POLL_INTERVAL = float(os.getenv("RECONCILIATION_POLL_INTERVAL", "21600"))
+# If set, events are only accepted with an "Authorization: Bearer <LIVE_EVENTS_SECRET>" header
+LIVE_EVENTS_SECRET = os.getenv("LIVE_EVENTS_SECRET")
+
+# Path of the endpoint receiving the events
+LIVE_EVENTS_PATH = "/live_events"
+# Events that can mean a course has new modules. Other events are accepted and ignored.
+MODULE_EVENT_NAMES = {"module_created", "module_updated", "module_item_created", "module_item_updated"}
+# Canvas sends global IDs in Live Events, which add the shard's ID times this to the course ID.
+CANVAS_SHARD_FACTOR = 10 ** 13
+
+
+def get_min_poll_interval() -> float:
+    return RECONCILIATION_POLL_INTERVAL if LIVE_EVENTS_ENABLED else scheduler.MIN_POLL_INTERVAL
+
+
+def parse_event(payload: Dict[str, Any]) -> Optional[CourseKey]:
+    """
+    Returns the course whose modules the given event is about, or None if it is not about modules.
+
+    Canvas Live Events keep the event's name and context in "metadata" and the changed object in
+    "body". Webhook-style events may put everything at the top level instead, e.g.
+    {"event_name": "module_created", "context_type": "Course", "context_id": 1234, "hostname": "canvas.ubc.ca"}.
+    """
+
+    metadata = payload.get("metadata", payload)
+    body = payload.get("body", payload)
+
+    if metadata.get("event_name") not in MODULE_EVENT_NAMES:
+        return None
+
+    context_type = body.get("context_type", metadata.get("context_type"))
+    context_id = body.get("context_id", metadata.get("context_id"))
+
+    if context_type != "Course" or not str(context_id).isdigit():
+        raise ValueError(f"Module event without a course: {payload!r}")
+
+    host = canvas_hosts.normalize_host(metadata.get("hostname") or DEFAULT_CANVAS_HOST)
+    return CourseKey(host, int(context_id) % CANVAS_SHARD_FACTOR)
+
+
+class LiveEventsReceiver:
+    """
+    Receives events on http://LIVE_EVENTS_HOST:LIVE_EVENTS_PORT/live_events and hands every course
+    whose modules changed to the course handler, which checks that course alone.
+
+    Events usually come in bursts, e.g. when a module and its items are published together. While
+    a course is being checked, further events for it only mark it to be checked once more
+    afterwards, so a burst costs at most two checks and no change made during a check is missed.
+    """
+
+    def __init__(self):
+        self.handle_course: Optional[Callable[[CourseKey], Awaitable[Any]]] = None
+        self.runner: Optional[web.AppRunner] = None
+        self.checking: Set[CourseKey] = set()
+        self.changed_again: Set[CourseKey] = set()
+        self.tasks: Set[asyncio.Task] = set()
+
+    def set_course_handler(self, handle_course: Callable[[CourseKey], Awaitable[Any]]):
+        self.handle_course = handle_course
+
+    async def handle_event(self, request: web.Request) -> web.Response:
+        if LIVE_EVENTS_SECRET and not hmac.compare_digest(request.headers.get("Authorization", ""),
+                                                          f"Bearer {LIVE_EVENTS_SECRET}"):
+            return web.Response(status=401)
+
+        try:
+            course_key = parse_event(await request.json())
+        except (ValueError, AttributeError):
+            print("[Error]: Received a malformed live event", flush=True)
+            return web.Response(status=400)
+
+        if course_key is None:
+            METRICS.increment("canvas_tracker_live_events_total", outcome="ignored")
+            return web.Response(status=202)
+
+        METRICS.increment("canvas_tracker_live_events_total", outcome="accepted")
+
+        if course_key in self.checking:
+            self.changed_again.add(course_key)
+        else:
+            self.checking.add(course_key)
+            task = asyncio.ensure_future(self._check_course(course_key))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+        return web.Response(status=202)
+
+    async def _check_course(self, course_key: CourseKey):
+        WATCHDOG.label_current_task(f"the live event check of course {course_key}")
+
+        try:
+            while self.handle_course is not None:
+                self.changed_again.discard(course_key)
+                await self.handle_course(course_key)
+
+                if course_key not in self.changed_again:
+                    break
+        except Exception:
+            print(f"[Error]: Failed to check course {course_key} after a live event", flush=True)
+            print(traceback.format_exc(), flush=True)
+        finally:
+            self.checking.discard(course_key)
+
+    async def start(self):
+        """
+        Starts receiving events, unless the receiver is already running or LIVE_EVENTS_ENABLED is off.
+        """
+
+        if not LIVE_EVENTS_ENABLED or self.runner is not None:
+            return
+
+        app = web.Application()
+        app.router.add_post(LIVE_EVENTS_PATH, self.handle_event)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, LIVE_EVENTS_HOST, LIVE_EVENTS_PORT).start()
+        print(f"Receiving live events on http://{LIVE_EVENTS_HOST}:{LIVE_EVENTS_PORT}{LIVE_EVENTS_PATH}", flush=True)
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+# Like the metrics server, the receiver is not part of an extension, so it keeps its port while the
+# bot's extensions are reloaded. The reloaded Tasks cog sets itself as the course handler.
+LIVE_EVENTS_RECEIVER = LiveEventsReceiver()
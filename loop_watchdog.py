@@ -0,0 +1,100 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+import weakref
+from typing import Optional
+
+from metrics import METRICS
+
+# Whether to measure the event loop's lag and log calls that block it (default: on)
+WATCHDOG_ENABLED = os.getenv("WATCHDOG_ENABLED", "1") == "1"
+# Interval, in seconds, at which the event loop's lag is sampled
+WATCHDOG_INTERVAL = float(os.getenv("WATCHDOG_INTERVAL", "0.5"))
+# Lag, in seconds, beyond which the event loop counts as blocked and the blocking call is logged
+WATCHDOG_THRESHOLD = float(os.getenv("WATCHDOG_THRESHOLD", "0.25"))
+
+
+class LoopWatchdog:
+    """
+    Measures how late the event loop wakes up from a short sleep, and logs the stack of whatever
+    is blocking the loop when it is late by more than WATCHDOG_THRESHOLD.
+
+    A coroutine on the loop records a heartbeat every WATCHDOG_INTERVAL, and a daemon thread
+    checks that the heartbeat keeps advancing. When it stops, the thread captures the loop
+    thread's current stack along with the label of the task that is running, so the log says
+    which command or course was blocking. Each stall is logged once, however long it lasts.
+    """
+
+    def __init__(self):
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread_id: Optional[int] = None
+        self.heartbeat = time.monotonic()
+        self.labels = weakref.WeakKeyDictionary()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        """
+        Starts watching the given loop, unless the watchdog is disabled or already running.
+        """
+
+        if not WATCHDOG_ENABLED or self.thread is not None:
+            return
+
+        self.loop = loop
+        loop.create_task(self._beat())
+        self.thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self.thread.start()
+
+    def label_current_task(self, activity: str):
+        """
+        Describes what the running task is doing, e.g. "course 1234", for stall reports.
+        """
+
+        task = asyncio.current_task()
+
+        if task is not None:
+            self.labels[task] = activity
+
+    async def _beat(self):
+        self.loop_thread_id = threading.get_ident()
+        self.label_current_task("watchdog")
+
+        while True:
+            expected = time.monotonic() + WATCHDOG_INTERVAL
+            await asyncio.sleep(WATCHDOG_INTERVAL)
+            now = time.monotonic()
+            METRICS.observe("canvas_tracker_event_loop_lag_seconds", max(0.0, now - expected))
+            self.heartbeat = now
+
+    def _get_activity(self) -> str:
+        try:
+            task = asyncio.current_task(self.loop)
+            return self.labels.get(task, "an unlabelled task") if task is not None else "a callback"
+        except RuntimeError:
+            # The labels changed while being read from this thread.
+            return "an unknown task"
+
+    def _watch(self):
+        reported_heartbeat = None
+
+        while True:
+            time.sleep(WATCHDOG_INTERVAL / 2)
+            heartbeat = self.heartbeat
+            lag = time.monotonic() - heartbeat - WATCHDOG_INTERVAL
+
+            if lag <= WATCHDOG_THRESHOLD or heartbeat == reported_heartbeat or self.loop_thread_id is None:
+                continue
+
+            reported_heartbeat = heartbeat
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "<stack unavailable>\n"
+            METRICS.increment("canvas_tracker_event_loop_stalls_total")
+            print(f"[Warning]: Event loop blocked for over {lag:.2f}s while running {self._get_activity()}. "
+                  f"Blocking call:\n{stack}", end="", flush=True)
+
+
+# Shared by every module so that reloading the bot's extensions does not start a second watchdog
+WATCHDOG = LoopWatchdog()
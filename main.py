@@ -7,6 +7,9 @@ from dotenv import load_dotenv
 load_dotenv()
 TOKEN = os.getenv("DISCORD_TOKEN")
 
+# Imported after loading .env, since it reads its settings when imported
+import sharding
+
 bot = commands.Bot(command_prefix='!', intents=discord.Intents.all())
 
 
@@ -17,5 +20,9 @@ async def on_ready():
 if __name__ == "__main__":
     bot.load_extension("commands")
     bot.load_extension("periodic_tasks")
+    workers = sharding.start_workers()
 
-bot.run(TOKEN)
+    try:
+        bot.run(TOKEN)
+    finally:
+        sharding.stop_workers(workers)
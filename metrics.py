@@ -0,0 +1,291 @@
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from aiohttp import web
+
+# Port of the local HTTP endpoint serving metrics in the Prometheus text format. The endpoint is
+# only started if this is set.
+METRICS_PORT = os.getenv("METRICS_PORT")
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Phases of polling a course. The course lookup is its own phase, so that canvas_fetch only
+# covers downloading the module list.
+COURSE_LOOKUP = "course_lookup"
+CANVAS_FETCH = "canvas_fetch"
+DIFF = "diff"
+EMBED_BUILD = "embed_build"
+DISCORD_SEND = "discord_send"
+PERSISTENCE = "persistence"
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    __slots__ = ("bucket_counts", "count", "total", "max")
+
+    def __init__(self):
+        self.bucket_counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.bucket_counts[index] += 1
+
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def to_list(self) -> List[Any]:
+        return [self.bucket_counts, self.count, self.total, self.max]
+
+    @staticmethod
+    def from_list(data: List[Any]) -> "Histogram":
+        histogram = Histogram()
+        histogram.bucket_counts, histogram.count, histogram.total, histogram.max = data
+        return histogram
+
+    def merge(self, other: "Histogram"):
+        for index, count in enumerate(other.bucket_counts):
+            self.bucket_counts[index] += count
+
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def get_quantile(self, quantile: float) -> float:
+        """
+        Returns the upper bound of the bucket containing the given quantile, capped at the
+        maximum observed value.
+        """
+
+        for index, count in enumerate(self.bucket_counts):
+            if count >= quantile * self.count:
+                return min(LATENCY_BUCKETS[index], self.max)
+
+        return self.max
+
+
+def _make_labels(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+
+    if not pairs:
+        return ""
+
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+class Metrics:
+    """
+    Counters and latency histograms for the polling pipeline, labelled by course and phase.
+
+    Polling workers record their metrics in their own process and forward the series that changed
+    to the coordinator (see pop_changed_series), which adds them to its own when they are read.
+    """
+
+    def __init__(self):
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.changed: Set[Tuple[str, Labels]] = set()
+        self.remote_counters: Dict[str, Dict[str, Dict[Labels, float]]] = {}
+        self.remote_histograms: Dict[str, Dict[str, Dict[Labels, Histogram]]] = {}
+        self.started_at = time.time()
+
+    def increment(self, name: str, amount: float = 1, **labels):
+        series = self.counters.setdefault(name, {})
+        key = _make_labels(labels)
+        series[key] = series.get(key, 0) + amount
+        self.changed.add((name, key))
+
+    def observe(self, name: str, value: float, **labels):
+        series = self.histograms.setdefault(name, {})
+        key = _make_labels(labels)
+
+        if key not in series:
+            series[key] = Histogram()
+
+        series[key].observe(value)
+        self.changed.add((name, key))
+
+    def mark_all_changed(self):
+        """
+        Makes the next pop_changed_series return every series, e.g. for a new coordinator.
+        """
+
+        self.changed.update((name, key) for name, series in self.counters.items() for key in series)
+        self.changed.update((name, key) for name, series in self.histograms.items() for key in series)
+
+    def pop_changed_series(self) -> Dict[str, List[Any]]:
+        """
+        Returns the current value of every series that changed since this was last called, in a
+        form that can be sent as JSON to add_remote_series.
+        """
+
+        counters, histograms = [], []
+
+        for name, key in self.changed:
+            if key in self.counters.get(name, {}):
+                counters.append([name, key, self.counters[name][key]])
+            else:
+                histograms.append([name, key, self.histograms[name][key].to_list()])
+
+        self.changed.clear()
+        return {"counters": counters, "histograms": histograms}
+
+    def add_remote_series(self, source: str, changed_series: Dict[str, List[Any]]):
+        """
+        Stores series returned by pop_changed_series in another process. They replace the earlier
+        values of the same series from the same source, and are kept after the source goes away.
+        """
+
+        for name, key, value in changed_series["counters"]:
+            labels = tuple(tuple(pair) for pair in key)
+            self.remote_counters.setdefault(source, {}).setdefault(name, {})[labels] = value
+
+        for name, key, value in changed_series["histograms"]:
+            labels = tuple(tuple(pair) for pair in key)
+            self.remote_histograms.setdefault(source, {}).setdefault(name, {})[labels] = Histogram.from_list(value)
+
+    def _get_all_counters(self) -> Dict[str, Dict[Labels, float]]:
+        all_counters = {name: dict(series) for name, series in self.counters.items()}
+
+        for counters in self.remote_counters.values():
+            for name, series in counters.items():
+                merged = all_counters.setdefault(name, {})
+
+                for key, value in series.items():
+                    merged[key] = merged.get(key, 0) + value
+
+        return all_counters
+
+    def _get_all_histograms(self) -> Dict[str, Dict[Labels, Histogram]]:
+        if not self.remote_histograms:
+            return self.histograms
+
+        all_histograms = {}
+
+        for histograms in [self.histograms, *self.remote_histograms.values()]:
+            for name, series in histograms.items():
+                merged = all_histograms.setdefault(name, {})
+
+                for key, histogram in series.items():
+                    merged.setdefault(key, Histogram()).merge(histogram)
+
+        return all_histograms
+
+    @contextmanager
+    def time_phase(self, phase: str, course: Optional[object] = None) -> Iterator[None]:
+        """
+        Records how long the body of the with statement takes as one observation of the given
+        phase, for the given course if any.
+        """
+
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            labels = {"phase": phase} if course is None else {"phase": phase, "course": course}
+            self.observe("canvas_tracker_phase_seconds", time.perf_counter() - start, **labels)
+
+    def get_phase_summary(self) -> Dict[str, Histogram]:
+        """
+        Returns each phase's latency histogram, merged across all courses.
+        """
+
+        summary = {}
+
+        for labels, histogram in self._get_all_histograms().get("canvas_tracker_phase_seconds", {}).items():
+            phase = dict(labels)["phase"]
+            summary.setdefault(phase, Histogram()).merge(histogram)
+
+        return summary
+
+    def get_slowest_courses(self, phase: str, limit: int) -> List[Tuple[str, float]]:
+        """
+        Returns the labels of the courses with the highest average latency in the given phase,
+        along with that average.
+        """
+
+        averages = []
+
+        for labels, histogram in self._get_all_histograms().get("canvas_tracker_phase_seconds", {}).items():
+            labels = dict(labels)
+            if labels["phase"] == phase and "course" in labels and histogram.count:
+                averages.append((labels["course"], histogram.total / histogram.count))
+
+        return sorted(averages, key=lambda average: average[1], reverse=True)[:limit]
+
+    def render(self) -> str:
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+
+        lines = []
+
+        for name, series in self._get_all_counters().items():
+            lines.append(f"# TYPE {name} counter")
+            lines.extend(f"{name}{_format_labels(labels)} {value}" for labels, value in series.items())
+
+        for name, series in self._get_all_histograms().items():
+            lines.append(f"# TYPE {name} histogram")
+
+            for labels, histogram in series.items():
+                for bound, count in zip(LATENCY_BUCKETS, histogram.bucket_counts):
+                    lines.append(f"{name}_bucket{_format_labels(labels, ('le', str(bound)))} {count}")
+
+                lines.append(f"{name}_bucket{_format_labels(labels, ('le', '+Inf'))} {histogram.count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram.total}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """
+    Serves METRICS on http://METRICS_HOST:METRICS_PORT/metrics.
+    """
+
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+        self.runner: Optional[web.AppRunner] = None
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.metrics.render(), content_type="text/plain")
+
+    async def start(self):
+        """
+        Starts serving metrics, unless the server is already running or METRICS_PORT is not set.
+        """
+
+        if not METRICS_PORT or self.runner is not None:
+            return
+
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle_metrics)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, METRICS_HOST, int(METRICS_PORT)).start()
+        print(f"Serving metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics", flush=True)
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+# Shared by every module. This module is not an extension, so the metrics and the server
+# survive reloading the bot's extensions.
+METRICS = Metrics()
+METRICS_SERVER = MetricsServer(METRICS)
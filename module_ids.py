@@ -0,0 +1,105 @@
+import os
+from array import array
+from bisect import bisect_left
+from typing import Iterable, Iterator
+
+import util
+
+# The log is compacted into the snapshot once it is larger than this many bytes, or larger than
+# half of the snapshot, whichever is greater
+MIN_COMPACTION_BYTES = 16384
+
+
+class ModuleIdSet:
+    """
+    An immutable set of module IDs stored as a sorted array of 64-bit ints. It takes 8 bytes
+    per ID, where a set of strs takes roughly ten times as much.
+    """
+
+    __slots__ = ("_ids",)
+
+    def __init__(self, module_ids: Iterable[int] = ()):
+        self._ids = array('q', sorted(set(module_ids)))
+
+    def __contains__(self, module_id: int) -> bool:
+        index = bisect_left(self._ids, module_id)
+        return index < len(self._ids) and self._ids[index] == module_id
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._ids)
+
+
+class ModuleIdLog:
+    """
+    Stores a course's module IDs in a snapshot file plus an append-only log of IDs added since
+    the snapshot was written. Adding IDs only appends to the log, and the log is periodically
+    compacted into a new snapshot.
+
+    Every write is crash-safe: appends are flushed to disk, a partial line left by a crash is
+    ignored and then removed before the next append, and snapshots are replaced atomically.
+    Because IDs in the log may also be in the snapshot, a crash between writing a snapshot and
+    clearing the log loses nothing.
+    """
+
+    def __init__(self, snapshot_path: str, log_path: str):
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path
+
+    @staticmethod
+    def _read_ids(file_path: str) -> Iterator[int]:
+        try:
+            with open(file_path, 'r') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return
+
+        lines = content.split("\n")
+
+        # The last element is either empty or a line that was only partially written.
+        for line in lines[:-1]:
+            if line:
+                yield int(line)
+
+    def read(self) -> ModuleIdSet:
+        return ModuleIdSet(list(self._read_ids(self.snapshot_path)) + list(self._read_ids(self.log_path)))
+
+    def is_empty(self) -> bool:
+        return all(not os.path.exists(path) or os.path.getsize(path) == 0
+                   for path in (self.snapshot_path, self.log_path))
+
+    def _remove_partial_line(self):
+        with open(self.log_path, 'rb+') as f:
+            content = f.read()
+
+            if content and not content.endswith(b"\n"):
+                f.truncate(content.rfind(b"\n") + 1)
+
+    def append(self, module_ids: Iterable[int]):
+        lines = "".join(f"{module_id}\n" for module_id in module_ids)
+
+        if not lines:
+            return
+
+        util.ensure_file_exists(self.log_path)
+        self._remove_partial_line()
+
+        with open(self.log_path, 'a') as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+        if self.needs_compaction():
+            self.compact()
+
+    def needs_compaction(self) -> bool:
+        snapshot_size = os.path.getsize(self.snapshot_path) if os.path.exists(self.snapshot_path) else 0
+        return os.path.getsize(self.log_path) > max(MIN_COMPACTION_BYTES, snapshot_size // 2)
+
+    def compact(self):
+        util.write_lines_atomically(self.snapshot_path, self.read())
+
+        with open(self.log_path, 'w'):
+            pass
@@ -0,0 +1,67 @@
+import hashlib
+import json
+import time
+from typing import Any, Dict, List, Optional
+
+from canvas_hosts import CourseKey
+
+# Discord accepts message nonces of at most this many characters
+NONCE_LENGTH = 25
+
+
+def make_nonce(value: str) -> str:
+    return hashlib.sha256(value.encode()).hexdigest()[:NONCE_LENGTH]
+
+
+class OutboxMessage:
+    """
+    A notification for one Discord channel that has been committed to storage but not fully sent.
+    It has either text content or embeds, which are kept as dicts (see discord.Embed.to_dict).
+
+    Embeds are packed into as few Discord messages as possible when they are sent, and
+    sent_embeds counts the embeds that have been sent so far, so delivery resumes where it stopped.
+    Digest messages to the same channel are packed together.
+
+    The dedup key is derived from the channel, the course and the IDs of the modules being
+    announced, so the same notification is never in the outbox twice, even if its modules are found
+    again after a crash. Messages that announce no modules are keyed by their contents instead.
+    """
+
+    __slots__ = ("dedup_key", "channel_id", "course_key", "content", "embeds", "digest", "sent_embeds", "created_at")
+
+    def __init__(self, dedup_key: str, channel_id: int, course_key: Optional[CourseKey], content: Optional[str],
+                 embeds: List[Dict[str, Any]], digest: bool = False, sent_embeds: int = 0,
+                 created_at: Optional[float] = None):
+        self.dedup_key = dedup_key
+        self.channel_id = channel_id
+        self.course_key = course_key
+        self.content = content
+        self.embeds = embeds
+        self.digest = digest
+        self.sent_embeds = sent_embeds
+        self.created_at = time.time() if created_at is None else created_at
+
+    @staticmethod
+    def create(channel_id: int, course_key: Optional[CourseKey] = None, content: Optional[str] = None,
+               embeds: Optional[List[Dict[str, Any]]] = None, digest: bool = False,
+               module_ids: Optional[List[int]] = None) -> "OutboxMessage":
+        embeds = embeds or []
+
+        if module_ids is not None:
+            identity = json.dumps([channel_id, course_key, sorted(module_ids)])
+        else:
+            identity = json.dumps([channel_id, course_key, content, embeds], sort_keys=True)
+
+        return OutboxMessage(make_nonce(identity), channel_id, course_key, content, embeds, digest)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {attribute: getattr(self, attribute) for attribute in self.__slots__}
+
+    @staticmethod
+    def from_dict(data: Dict[str, Any]) -> "OutboxMessage":
+        data = dict(data)
+        data["course_key"] = CourseKey(*data["course_key"]) if data.get("course_key") else None
+        return OutboxMessage(**data)
+
+    def __repr__(self):
+        return f"OutboxMessage(dedup_key={self.dedup_key}, channel_id={self.channel_id})"
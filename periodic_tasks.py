@@ -1,222 +1,700 @@
+import abc
 import asyncio
 import os
-import shutil
+import time
 import traceback
-from typing import List, Union
+from collections import Counter
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional
 
-import canvasapi.exceptions
-from canvasapi import Canvas
-from canvasapi.course import Course
-from canvasapi.module import Module, ModuleItem
 import discord
 from discord.ext import commands
 from discord.ext.commands import Bot
 from dotenv import load_dotenv
 
-import util
+import canvas_client
+import canvas_hosts
+import live_events
+import metrics
+import scheduler
+import sharding
+import storage
+from canvas_client import CanvasClient, Course, ModuleRecord
+from canvas_hosts import DEFAULT_CANVAS_HOST, CourseKey
+from delivery import DeliveryDispatcher
+from live_events import LIVE_EVENTS_RECEIVER
+from loop_watchdog import WATCHDOG
+from metrics import METRICS, METRICS_SERVER
+from outbox import OutboxMessage
+from response_cache import ResponseCache
+from scheduler import PollScheduler
+from sharding import ShardCoordinator
+from single_flight import SingleFlight
 from util import CanvasUtil
+from watcher_registry import WatcherRegistry
 
 load_dotenv()
 
-# Do *not* put a slash at the end of this path
-COURSES_DIRECTORY = "./data/courses"
+# Do *not* put a slash at the end of these paths
+DATA_DIRECTORY = os.getenv("DATA_DIRECTORY", "./data")
+COURSES_DIRECTORY = f"{DATA_DIRECTORY}/courses"
+DATABASE_PATH = f"{DATA_DIRECTORY}/canvas_tracker.db"
+OUTBOX_DIRECTORY = f"{DATA_DIRECTORY}/outbox"
 
-CANVAS_URL = "https://canvas.ubc.ca/"
-CANVAS_TOKEN = os.getenv("CANVAS_TOKEN")
-CANVAS_INSTANCE = Canvas(CANVAS_URL, CANVAS_TOKEN) if CANVAS_TOKEN else None
+# Either "sqlite" or "files". The "files" backend keeps one directory per course in COURSES_DIRECTORY.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+STORAGE = storage.create_storage(STORAGE_BACKEND, COURSES_DIRECTORY, DATABASE_PATH, DEFAULT_CANVAS_HOST,
+                                 OUTBOX_DIRECTORY)
+WATCHERS = WatcherRegistry(STORAGE)
+DISPATCHER = DeliveryDispatcher(STORAGE)
+
+# One client per Canvas host in CANVAS_HOSTS that has a token. Each client has its own connection
+# pool and rate-limit budget.
+CANVAS_INSTANCES: Dict[str, CanvasClient] = {host: CanvasClient(f"https://{host}/", token)
+                                             for host, token in canvas_hosts.get_tokens().items() if token}
 
 # Module names and ModuleItem titles are truncated to this length
 MAX_IDENTIFIER_LENGTH = 100
 RED = 0xff0000
 EMBED_CHAR_LIMIT = 6000
 
+# Longest time, in seconds, the scheduler sleeps before checking for newly tracked courses
+MAX_SCHEDULER_SLEEP = 60
+
+# Maximum number of courses on the same Canvas host polled at the same time during a sweep
+POLL_CONCURRENCY = int(os.getenv("POLL_CONCURRENCY", "8"))
+# Seconds a single course may take before we give up on it for this sweep
+COURSE_POLL_TIMEOUT = float(os.getenv("COURSE_POLL_TIMEOUT", "300"))
+# If enabled, a course whose updated_at timestamp has not changed since the last poll is skipped
+# without requesting its modules. Not every Canvas instance bumps updated_at when modules change.
+CHANGE_PROBE_ENABLED = os.getenv("CHANGE_PROBE_ENABLED", "0") == "1"
+# If enabled, each channel receives the new modules of all of its courses together at the end of
+# a sweep, instead of separately for each course
+DIGEST_MODE_ENABLED = os.getenv("DIGEST_MODE_ENABLED", "0") == "1"
+
+# Polls of a course that is already being polled, and sweeps of all courses started while one is
+# in progress, join the poll or sweep in progress instead of fetching everything again.
+COURSE_POLLS = SingleFlight()
+FULL_SWEEPS = SingleFlight()
+# Number of snapshots (see start_snapshots) in progress for each course. Polling workers do not
+# take part in them, so these courses are not assigned to workers until they are done.
+PENDING_SNAPSHOTS: "Counter[CourseKey]" = Counter()
+
 
 def setup(bot: Bot):
+    DISPATCHER.set_http_client(bot.http)
     bot.add_cog(Tasks(bot))
     print("Loaded Tasks cog", flush=True)
 
-    if not CANVAS_TOKEN:
-        print("[Error]: Could not find CANVAS_TOKEN variable in .env file", flush=True)
+    for host, token in canvas_hosts.get_tokens().items():
+        if not token:
+            print(f"[Error]: Could not find {canvas_hosts.get_token_variable(host)} variable in .env file", flush=True)
 
 
 class Tasks(commands.Cog):
     def __init__(self, bot: Bot):
         self.bot = bot
+        self.schedulers = create_schedulers(CANVAS_INSTANCES)
         self.tasks = []
-        self.tasks.append(bot.loop.create_task(self.check_canvas_hourly()))
-    
+        self.coordinator = None
+
+        if sharding.COORDINATOR_ENABLED:
+            # Polling workers poll the courses, and this process only delivers what they find.
+            self.coordinator = ShardCoordinator(get_assignable_course_keys, lambda: DiscordNotifier(bot),
+                                                CourseCommit.from_dict)
+            self.tasks.append(bot.loop.create_task(self.start_coordinator()))
+        else:
+            self.tasks.extend(bot.loop.create_task(self.check_canvas_when_due(host)) for host in CANVAS_INSTANCES)
+
+        self.tasks.append(bot.loop.create_task(self.restore_outbox()))
+
+        bot.loop.create_task(METRICS_SERVER.start())
+        LIVE_EVENTS_RECEIVER.set_course_handler(self.check_course_after_event)
+        bot.loop.create_task(LIVE_EVENTS_RECEIVER.start())
+        WATCHDOG.start(bot.loop)
+
+        if not CANVAS_INSTANCES:
+            print("[Error]: No Canvas instance exists!", flush=True)
+
     def cog_unload(self):
+        LIVE_EVENTS_RECEIVER.set_course_handler(None)
+
         for task in self.tasks:
             task.cancel()
 
-    async def check_canvas_hourly(self):
+        # Polls are shielded from the tasks waiting for them, so they are cancelled separately
+        # before the storage they write to is closed.
+        FULL_SWEEPS.cancel_all()
+        COURSE_POLLS.cancel_all()
+
+        if self.coordinator:
+            self.coordinator.stop()
+
+        for client in CANVAS_INSTANCES.values():
+            self.bot.loop.create_task(client.close())
+
+        for poll_scheduler in self.schedulers.values():
+            STORAGE.set_schedules(poll_scheduler.pop_changed_schedules())
+
+        DISPATCHER.close()
+        WATCHERS.flush()
+        STORAGE.close()
+
+    async def start_coordinator(self):
+        """
+        Starts accepting polling workers once the bot is ready. Until then, no channel can be found,
+        so the results of the workers would make every course look unwatched and be deleted.
+        """
+
+        await self.bot.wait_until_ready()
+        await self.coordinator.start()
+
+    async def restore_outbox(self):
         """
-        This function checks the Canvas courses we are tracking every hour, sending any new modules
-        to all Discord channels that are tracking those courses.
+        Resumes delivering the messages that were left in the outbox when the bot last stopped.
         """
 
         await self.bot.wait_until_ready()
+        DISPATCHER.restore()
 
-        while not self.bot.is_closed():
-            if CANVAS_INSTANCE:
-                try:
-                    await check_canvas(self.bot)
-                except Exception:
-                    print(traceback.format_exc(), flush=True)
-            else:
-                print("[Error]: No Canvas instance exists!", flush=True)
+    async def check_canvas_when_due(self, host: str):
+        """
+        This function checks each Canvas course we are tracking on the given host whenever the
+        scheduler says the course is due, sending any new modules to all Discord channels that are
+        tracking the course. Each course has its own polling interval, so polls are spread out
+        instead of happening in one hourly burst.
+
+        Every host runs its own copy of this loop with its own scheduler, so a slow or throttled
+        host never holds up the courses of the others.
+        """
+
+        WATCHDOG.label_current_task(f"the poll scheduler for {host}")
+        await self.bot.wait_until_ready()
+        await poll_when_due(self.schedulers[host], lambda: WATCHERS.get_course_keys(host),
+                            lambda course_keys: check_canvas(self.bot, course_keys))
 
-            await asyncio.sleep(3600)
+    async def check_course_after_event(self, course_key: CourseKey):
+        """
+        Checks a course that a live event says has changed, right away and without waiting for it to
+        be due. Its next scheduled poll is pushed back, since the course has just been checked.
+
+        This always happens in this process, even when polling workers poll the scheduled courses.
+        Events that arrive while the bot is starting are only handled once it is ready, since before
+        that no channel can be found and the course would look unwatched.
+        """
+
+        await self.bot.wait_until_ready()
 
+        if not WATCHERS.get_channels(course_key) or course_key.host not in CANVAS_INSTANCES:
+            return
 
-async def check_canvas(bot: Bot):
+        # A poll that is already in progress may have fetched the modules before the change, so the
+        # course is checked again once it is done. The course's updated_at is not always bumped by a
+        # change to its modules, so the change probe is skipped.
+        joined_poll = COURSE_POLLS.is_in_flight(course_key)
+        outcomes = await check_canvas(self.bot, [course_key], probe_changes=False)
+
+        if joined_poll:
+            outcomes = await check_canvas(self.bot, [course_key], probe_changes=False)
+
+        if not sharding.COORDINATOR_ENABLED:
+            self.schedulers[course_key.host].record_outcome(course_key, outcomes[course_key])
+
+
+def create_schedulers(hosts: Iterable[str]) -> Dict[str, PollScheduler]:
+    """
+    Returns a scheduler for each of the given hosts, which resumes the schedules saved before the
+    bot last stopped or was reloaded.
     """
-    For every Canvas course being tracked, we retrieve all modules from the course, filter out
-    the previously-known modules, and send the new modules into all Discord channels tracking the
-    course. The term "watchers" refers to these channels.
 
-    Each course's modules and watchers are stored in a folder on the local filesystem.
+    schedules = STORAGE.get_schedules()
+    schedulers = {}
 
-    NOTE: the Canvas API distinguishes between a Module and a ModuleItem. In our documentation, though,
-    the word "module" can refer to both; we do not distinguish between the two types.
+    for host in hosts:
+        schedulers[host] = PollScheduler(live_events.get_min_poll_interval())
+        schedulers[host].restore({course_key: schedule for course_key, schedule in schedules.items()
+                                  if course_key.host == host})
+
+    return schedulers
+
+
+async def poll_when_due(poll_scheduler: PollScheduler, get_course_keys: Callable[[], Iterable[CourseKey]],
+                        poll: Callable[[List[CourseKey]], Awaitable[Dict[CourseKey, str]]]):
+    """
+    Forever polls each course returned by get_course_keys whenever poll_scheduler says it is due,
+    and reschedules the courses according to the outcomes returned by poll. The changed schedules
+    are saved after every round, in one batch.
+    """
+
+    while True:
+        poll_scheduler.sync(get_course_keys())
+        due_course_keys = poll_scheduler.pop_due()
+
+        if due_course_keys:
+            try:
+                outcomes = await poll(due_course_keys)
+            except Exception:
+                print(traceback.format_exc(), flush=True)
+                outcomes = {course_key: scheduler.FAILED for course_key in due_course_keys}
+
+            for course_key, outcome in outcomes.items():
+                poll_scheduler.record_outcome(course_key, outcome)
+
+        # This also saves the schedules of courses checked after live events.
+        changed_schedules = poll_scheduler.pop_changed_schedules()
+
+        if changed_schedules:
+            STORAGE.set_schedules(changed_schedules)
+
+        await asyncio.sleep(min(poll_scheduler.get_seconds_until_next_due(), MAX_SCHEDULER_SLEEP))
+
+
+def get_field_value(module: ModuleRecord) -> str:
+    """
+    This function returns a string that can be added to a Discord embed as a field's value. The
+    string contains the module's name/title and, if present, a hyperlink to the module. If the
+    module name is too long, we truncate it and add an ellipsis.
+    """
+
+    field = module.name
+
+    if len(field) > MAX_IDENTIFIER_LENGTH:
+        field = f"{field[:MAX_IDENTIFIER_LENGTH - 3]}..."
+
+    if module.html_url:
+        field = f"[{field}]({module.html_url})"
+
+    return field
+
+
+def get_embeds(course: Course, modules: List[ModuleRecord]) -> List[discord.Embed]:
+    """
+    Returns a list of Discord embeds to send to watcher channels.
+    """
+
+    embed = discord.Embed(title=f"New modules found for {course.name}:", color=RED)
+    embed_list = []
+
+    for module in modules:
+        field_value = get_field_value(module)
+        field_name = "Module" if module.kind == canvas_client.MODULE else "Module Item"
+        field_length = len(field_name) + len(field_value)
+
+        if len(embed.fields) >= 25 or field_length + len(embed) > EMBED_CHAR_LIMIT:
+            embed_list.append(embed)
+            embed = discord.Embed(title=f"New modules found for {course.name} (continued):", color=RED)
+
+        embed.add_field(name=field_name, value=field_value, inline=False)
+
+    if len(embed.fields) != 0:
+        embed_list.append(embed)
+
+    return embed_list
+
+
+class CourseCommit:
+    """
+    What must be stored after a course was polled: its name, the IDs of its new modules and its
+    response cache, which is None if it has not changed. Calling it stores them together with the
+    messages announcing the modules. Notifiers only call it while somebody watches the course, so
+    a course that was just forgotten is not stored again.
+
+    A polling worker does not call it, but sends it to the coordinator, which stores it with the
+    messages. The modules are then never stored as known while their messages could still be lost.
+    """
+
+    __slots__ = ("course_key", "course_name", "module_ids", "response_cache")
+
+    def __init__(self, course_key: CourseKey, course_name: str, module_ids: List[int],
+                 response_cache: Optional[Dict[str, Any]]):
+        self.course_key = course_key
+        self.course_name = course_name
+        self.module_ids = module_ids
+        self.response_cache = response_cache
+
+    def __call__(self, messages: List[OutboxMessage]):
+        if STORAGE.get_course_name(self.course_key) != self.course_name:
+            STORAGE.set_course_name(self.course_key, self.course_name)
+
+        if self.response_cache is not None:
+            with METRICS.time_phase(metrics.PERSISTENCE, self.course_key):
+                STORAGE.commit_new_modules(self.course_key, self.module_ids, self.response_cache, messages)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {attribute: getattr(self, attribute) for attribute in self.__slots__}
+
+    @staticmethod
+    def from_dict(data: Dict[str, Any]) -> "CourseCommit":
+        return CourseCommit(CourseKey(*data["course_key"]), data["course_name"], data["module_ids"],
+                            data["response_cache"])
+
+
+class PollNotifier(abc.ABC):
     """
-    
-    def get_field_value(module: Union[Module, ModuleItem]) -> str:
+    Receives what poll_courses finds. DiscordNotifier delivers it to the watchers of each course,
+    while a polling worker forwards it to the process that owns the Discord connection.
+    """
+
+    @abc.abstractmethod
+    def send_new_modules(self, course_key: CourseKey, course: Course, modules: List[ModuleRecord],
+                         commit: CourseCommit) -> bool:
         """
-        This function returns a string that can be added to a Discord embed as a field's value. The
-        string contains the module's name/title and, if present, a hyperlink to the module. If the
-        module name is too long, we truncate it and add an ellipsis.
+        Sends the given new modules of a course, which may be none, to the course's watchers.
+        The messages announcing them must be passed to commit, which stores them in the outbox
+        together with the modules, before they are sent.
+
+        Returns False if nobody watches the course anymore; the notifier then forgets the course
+        without committing anything.
         """
 
-        if hasattr(module, "title"):
-            field = module.title
-        else:
-            field = module.name
-        
-        if len(field) > MAX_IDENTIFIER_LENGTH:
-            field = f"{field[:MAX_IDENTIFIER_LENGTH - 3]}..."
+        raise NotImplementedError
 
-        if hasattr(module, "html_url"):
-            field = f"[{field}]({module.html_url})"
-        
-        return field
+    @abc.abstractmethod
+    def remove_inaccessible_course(self, course_key: CourseKey):
+        raise NotImplementedError
 
-    def get_embeds(course: Course, modules: List[Union[Module, ModuleItem]]) -> List[discord.Embed]:
+    def finish(self):
         """
-        Returns a list of Discord embeds to send to watcher channels.
+        Called once the sweep is over.
         """
 
-        embed = discord.Embed(title=f"New modules found for {course.name}:", color=RED)
-        embed_list = []
+        pass
 
-        for module in modules:
-            field_value = get_field_value(module)
-            field_name = "Module" if isinstance(module, Module) else "Module Item"
-            field_length = len(field_name) + len(field_value)
 
-            if len(embed.fields) >= 25 or field_length + len(embed) > EMBED_CHAR_LIMIT:
-                embed_list.append(embed)
-                embed = discord.Embed(title=f"New modules found for {course.name} (continued):", color=RED)
+class DiscordNotifier(PollNotifier):
+    """
+    Commits a message with the new modules' embeds to the outbox for every valid Discord text
+    channel watching each course, and queues the messages for delivery.
 
-            embed.add_field(name=field_name, value=field_value, inline=False)
+    In digest mode, the messages are only queued when the sweep finishes, and all of them for the
+    same channel are sent together. Watchers that are no longer valid Discord text channels are
+    collected in missing_channel_ids, and are removed from every course when the sweep finishes.
+    """
 
-        if len(embed.fields) != 0:
-            embed_list.append(embed)
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self.missing_channel_ids = set()
+        self.digest_messages = []
 
-        return embed_list
-    
-    async def send_embeds_and_cleanup_watchers_file(embed_list: List[discord.Embed], watchers_file_path: str):
-        """
-        Sends all embeds in embed_list to all valid Discord text channels listed in the watchers
-        file inside the given course directory.
+    def send_new_modules(self, course_key: CourseKey, course: Course, modules: List[ModuleRecord],
+                         commit: CourseCommit) -> bool:
+        with METRICS.time_phase(metrics.EMBED_BUILD, course_key):
+            embeds = [embed.to_dict() for embed in get_embeds(course, modules)]
 
-        We remove any line in the watchers file that is not a valid Discord text channel ID.
-        """
+        module_ids = [module.id for module in modules]
+        has_valid_watcher = False
+        messages = []
 
-        with open(watchers_file_path, "r") as f:
-            channel_ids = f.read().splitlines()
+        for channel_id in WATCHERS.get_channels(course_key):
+            if not self.bot.get_channel(channel_id):
+                self.missing_channel_ids.add(channel_id)
+                continue
 
-        with open(watchers_file_path, "w") as f:
-            for channel_id in channel_ids:
-                channel = bot.get_channel(int(channel_id))
+            has_valid_watcher = True
 
-                if channel:
-                    f.write(channel_id + "\n")
+            if embeds:
+                messages.append(OutboxMessage.create(channel_id, course_key, embeds=embeds, digest=DIGEST_MODE_ENABLED,
+                                                     module_ids=module_ids))
 
-                    for element in embed_list:
-                        await channel.send(embed=element)
+        # Forget the course if there are no more channels watching it.
+        if not has_valid_watcher:
+            delete_course(course_key)
+            return False
 
-    def get_new_modules(retrieved_modules: List[Union[Module, ModuleItem]],
-                        course_id: str) -> List[Union[Module, ModuleItem]]:
-        modules_file = CanvasUtil.get_modules_file_path(course_id)
-        util.ensure_file_exists(modules_file)
+        commit(messages)
 
-        with open(modules_file, 'r') as m:
-            existing_modules = set(m.read().splitlines())
+        if DIGEST_MODE_ENABLED:
+            self.digest_messages.extend(messages)
+        else:
+            for message in messages:
+                DISPATCHER.enqueue(message)
 
-        return list(filter(lambda module: str(module.id) not in existing_modules, retrieved_modules))
+        return True
 
-    def ensure_course_folder_name_is_correct(course_id: str, current_course_folder_name: str) -> str:
-        current_course_directory = f"{COURSES_DIRECTORY}/{current_course_folder_name}"
-        course_directory = CanvasUtil.get_course_directory(course_id)
-        if current_course_directory != course_directory:
-            os.rename(current_course_directory, course_directory)
+    def remove_inaccessible_course(self, course_key: CourseKey):
+        course_name = STORAGE.get_course_name(course_key)
 
-        return course_directory
+        content = (f"Removing course {course_name} (ID: {course_key.course_id} on {course_key.host}) from courses "
+                   f"being tracked; course access denied.")
+        messages = [OutboxMessage.create(channel_id, course_key, content=content)
+                    for channel_id in WATCHERS.get_channels(course_key) if self.bot.get_channel(channel_id)]
+        STORAGE.add_outbox_messages(messages)
 
-    async def remove_inaccessible_course(discord_bot: Bot, course_directory: str):
-        try:
-            with open(CanvasUtil.get_course_name_file_path_by_course_dir(course_directory), 'r') as f:
-                course_name = f.readline().strip('\n')
-        except FileNotFoundError:
-            course_name = "<Course name not found>"
+        for message in messages:
+            DISPATCHER.enqueue(message)
 
-        try:
-            with open(CanvasUtil.get_watchers_file_path_by_course_dir(course_directory), 'r') as w:
-                for channel_id in w:
-                    channel = discord_bot.get_channel(int(channel_id.rstrip()))
+        delete_course(course_key)
+
+    def finish(self):
+        for message in self.digest_messages:
+            DISPATCHER.enqueue(message)
+
+        self.digest_messages = []
+
+        with METRICS.time_phase(metrics.PERSISTENCE):
+            WATCHERS.prune_channels(self.missing_channel_ids)
+            WATCHERS.flush()
+
+        self.missing_channel_ids = set()
+
+
+async def check_canvas(bot: Bot, course_keys: Optional[Iterable[CourseKey]] = None,
+                       probe_changes: bool = True) -> Dict[CourseKey, str]:
+    """
+    For every given Canvas course (by default, every course being tracked), we retrieve all modules
+    from the course, filter out the previously-known modules, and send the new modules into all
+    Discord channels tracking the course. The term "watchers" refers to these channels.
+
+    Each course's modules are kept in STORAGE, and its watchers are kept in WATCHERS.
+
+    Returns the outcome of polling each course, as one of the outcomes defined in scheduler.
+
+    A sweep of all courses started while another one is in progress joins that sweep, and a course
+    that is already being polled is not polled again (see poll_courses).
+
+    NOTE: the Canvas API distinguishes between a Module and a ModuleItem. In our documentation, though,
+    the word "module" can refer to both; we do not distinguish between the two types.
+    """
+
+    if course_keys is None:
+        return await FULL_SWEEPS.run(None, lambda: check_canvas(bot, WATCHERS.get_course_keys()))
+
+    notifier = DiscordNotifier(bot)
+    outcomes = await poll_courses(course_keys, notifier, probe_changes)
+    notifier.finish()
+    DISPATCHER.report()
+
+    return outcomes
+
+
+async def poll_courses(course_keys: Iterable[CourseKey], notifier: PollNotifier,
+                       probe_changes: bool = True) -> Dict[CourseKey, str]:
+    """
+    Polls every given course for modules that are not in STORAGE yet and hands them to the
+    notifier, which has them stored together with the messages announcing them. This part of
+    check_canvas does not need Discord, so polling workers run it too.
+
+    Courses on different Canvas hosts are polled with different clients, and each host has its own
+    POLL_CONCURRENCY slots. Courses on hosts without a client are skipped.
 
-                    if channel:
-                        await channel.send(f"Removing course {course_name} (ID: {course_directory.split('/')[-1]}) "
-                                           f"from courses being tracked; course access denied.")
-        except FileNotFoundError:
-            pass
+    A course that is already being polled, e.g. by a scheduled sweep when !update_courses asks for
+    it, is not polled again; the poll in progress is joined instead. Its new modules are only handed to
+    the notifier of the poll that found them, so nothing is announced twice.
 
-        shutil.rmtree(course_directory)
+    If probe_changes is off, the modules of every course are requested even if CHANGE_PROBE_ENABLED
+    is on and the course's updated_at has not changed.
+
+    Returns the outcome of polling each course, as one of the outcomes defined in scheduler.
+    """
+
+    async def get_new_modules(retrieved_modules: AsyncIterator[ModuleRecord],
+                              existing_module_ids) -> List[ModuleRecord]:
+        # Modules are compared as they arrive, so only the new ones are kept.
+        return [module async for module in retrieved_modules if module.id not in existing_module_ids]
+
+    async def retrieve_and_send_new_modules(course_key: CourseKey) -> str:
+        WATCHDOG.label_current_task(f"the poll of course {course_key}")
+        client = CANVAS_INSTANCES[course_key.host]
 
-    async def retrieve_and_send_new_modules(course_id: str):
         try:
-            course = CANVAS_INSTANCE.get_course(int(course_id_str))
-        except (canvasapi.exceptions.InvalidAccessToken, canvasapi.exceptions.Unauthorized,
-                canvasapi.exceptions.Forbidden):
+            with METRICS.time_phase(metrics.COURSE_LOOKUP, course_key):
+                course = await client.get_course(course_key.course_id)
+        except (canvas_client.InvalidAccessToken, canvas_client.Unauthorized, canvas_client.Forbidden):
             raise InaccessibleCanvasCourseException()
 
-        CanvasUtil.store_course_name_locally(course_id, course.name)
+        cache = ResponseCache(STORAGE.get_response_cache(course_key))
+        course_updated_at = getattr(course, "updated_at", None)
+
+        skip_unchanged = CHANGE_PROBE_ENABLED and probe_changes
+        new_modules = None
+
+        if not (skip_unchanged and course_updated_at and course_updated_at == cache.course_updated_at):
+            print(f"Downloading modules for {course.name}", flush=True)
+
+            with METRICS.time_phase(metrics.DIFF, course_key):
+                existing_module_ids = STORAGE.get_module_ids(course_key)
+
+            # Each page is diffed as soon as it arrives, so diffing is timed as part of the download.
+            try:
+                with METRICS.time_phase(metrics.CANVAS_FETCH, course_key):
+                    all_modules = CanvasUtil.get_modules(client, course_key.course_id, cache)
+                    new_modules = await get_new_modules(all_modules, existing_module_ids)
+            except canvas_client.NotModified:
+                pass
+
+        modified = new_modules is not None
+
+        if not modified:
+            print(f"No changes found for {course.name}; skipping", flush=True)
+            skipped["courses"] += 1
+            skipped["bytes"] += cache.get_total_size()
+            new_modules = []
+
+        if modified:
+            cache.course_updated_at = course_updated_at
+            commit = CourseCommit(course_key, course.name, [module.id for module in new_modules], cache.to_dict())
+        elif course_updated_at and course_updated_at != cache.course_updated_at:
+            # Nothing was found, but the course's updated_at changed for another reason. It is
+            # stored, without any module IDs, so that the change probe matches again next time.
+            cache.course_updated_at = course_updated_at
+            commit = CourseCommit(course_key, course.name, [], cache.to_dict())
+        else:
+            commit = CourseCommit(course_key, course.name, [], None)
+
+        if not notifier.send_new_modules(course_key, course, new_modules, commit):
+            return scheduler.REMOVED
 
-        print(f"Downloading modules for {course.name}", flush=True)
-        all_modules = CanvasUtil.get_modules(course)
-        embeds_to_send = get_embeds(course, get_new_modules(all_modules, course_id))
+        METRICS.increment("canvas_tracker_new_modules_total", len(new_modules), course=course_key)
 
-        watchers_file = CanvasUtil.get_watchers_file_path_by_course_id(course_id)
-        util.ensure_file_exists(watchers_file)
-        await send_embeds_and_cleanup_watchers_file(embeds_to_send, watchers_file)
+        return scheduler.CHANGED if new_modules else scheduler.UNCHANGED
 
-        # Delete the course directory if there are no more channels watching the course.
-        if os.stat(watchers_file).st_size == 0:
-            shutil.rmtree(CanvasUtil.get_course_directory(course_id))
+    async def poll_course(course_key: CourseKey) -> str:
+        """
+        Polls a single course while holding a slot in its host's worker pool, and returns the
+        outcome. Any failure is contained here so that one bad course cannot hold up or abort the
+        rest of the sweep.
+        """
+
+        if course_key.host not in semaphores:
+            semaphores[course_key.host] = asyncio.Semaphore(max(1, POLL_CONCURRENCY))
+
+        async with semaphores[course_key.host]:
+            start = time.perf_counter()
+
+            try:
+                outcome = await asyncio.wait_for(retrieve_and_send_new_modules(course_key), COURSE_POLL_TIMEOUT)
+            except InaccessibleCanvasCourseException:
+                notifier.remove_inaccessible_course(course_key)
+                outcome = scheduler.REMOVED
+            except canvas_client.RateLimitExceeded:
+                print(f"[Error]: Canvas rate limit exceeded while polling course {course_key}", flush=True)
+                outcome = scheduler.THROTTLED
+            except asyncio.TimeoutError:
+                print(f"[Error]: Timed out polling course {course_key} after {COURSE_POLL_TIMEOUT}s", flush=True)
+                outcome = scheduler.FAILED
+            except Exception:
+                print(f"[Error]: Failed to poll course {course_key}", flush=True)
+                print(traceback.format_exc(), flush=True)
+                outcome = scheduler.FAILED
+
+            METRICS.increment("canvas_tracker_polls_total", course=course_key, outcome=outcome)
+            print(f"Polled course {course_key} in {time.perf_counter() - start:.2f}s", flush=True)
+
+        return outcome
+
+    async def poll_or_join(course_key: CourseKey):
+        if COURSE_POLLS.is_in_flight(course_key):
+            print(f"Course {course_key} is already being polled; waiting for that poll", flush=True)
+            METRICS.increment("canvas_tracker_coalesced_polls_total", course=course_key)
+
+        # Joining a poll does not take a slot, since the poll in progress already holds one.
+        outcomes[course_key] = await COURSE_POLLS.run(course_key, lambda: poll_course(course_key))
+
+    sweep_start = time.perf_counter()
+    skipped = {"courses": 0, "bytes": 0}
+    outcomes = {}
+    semaphores = {}
+    polls = []
+
+    for course_key in course_keys:
+        if course_key.host in CANVAS_INSTANCES:
+            polls.append(poll_or_join(course_key))
         else:
-            CanvasUtil.write_modules_to_file(CanvasUtil.get_modules_file_path(course_id), all_modules)
-
-    if os.path.exists(COURSES_DIRECTORY):
-        for course_folder_name in os.listdir(COURSES_DIRECTORY):
-            course_id_str = course_folder_name.split()[0]
-            if course_id_str.isdigit():
-                course_dir = ensure_course_folder_name_is_correct(course_id_str, course_folder_name)
-
-                try:
-                    await retrieve_and_send_new_modules(course_id_str)
-                except InaccessibleCanvasCourseException:
-                    await remove_inaccessible_course(bot, course_dir)
+            print(f"[Error]: Skipping course {course_key}; no Canvas instance exists for {course_key.host}", flush=True)
+
+    await asyncio.gather(*polls)
+
+    METRICS.observe("canvas_tracker_sweep_seconds", time.perf_counter() - sweep_start)
+    print(f"Sweep of {len(polls)} courses finished in {time.perf_counter() - sweep_start:.2f}s", flush=True)
+    print(f"Skipped {skipped['courses']} unchanged courses, avoiding {skipped['bytes']} bytes of downloads",
+          flush=True)
+
+    for host in semaphores:
+        throttle = CANVAS_INSTANCES[host].throttle
+        print(f"Canvas rate-limit budget for {host}: {throttle.remaining:.0f} units left, "
+              f"{throttle.throttled_count} requests throttled so far", flush=True)
+
+    return outcomes
+
+
+def start_snapshots(course_keys: Iterable[CourseKey], channel_id: int) -> "asyncio.Future[List[CourseKey]]":
+    """
+    Starts storing the IDs of the current modules of every given course that has none stored yet,
+    so that only modules published afterwards are announced. Courses whose snapshot failed are no
+    longer tracked in the given channel, and the returned future resolves to them.
+
+    The snapshots are taken concurrently, within each host's POLL_CONCURRENCY slots. A snapshot
+    counts as a poll of its course from the moment this returns, so a poll of the course in this
+    process joins the snapshot instead of announcing every existing module as new. Polling workers
+    cannot join it, so the course is withheld from them until it is done (see get_assignable_course_keys).
+    """
+
+    semaphores = {}
+
+    async def take_snapshot(course_key: CourseKey) -> str:
+        WATCHDOG.label_current_task(f"the snapshot of course {course_key}")
+
+        if course_key.host not in semaphores:
+            semaphores[course_key.host] = asyncio.Semaphore(max(1, POLL_CONCURRENCY))
+
+        try:
+            async with semaphores[course_key.host]:
+                if not STORAGE.has_module_ids(course_key):
+                    modules = CanvasUtil.get_modules(CANVAS_INSTANCES[course_key.host], course_key.course_id)
+                    STORAGE.add_module_ids(course_key, [module.id async for module in modules])
+        except Exception:
+            print(f"[Error]: Failed to take a snapshot of course {course_key}", flush=True)
+            print(traceback.format_exc(), flush=True)
+            return scheduler.FAILED
+
+        return scheduler.UNCHANGED
+
+    course_keys = list(course_keys)
+    PENDING_SNAPSHOTS.update(course_keys)
+    snapshots = [COURSE_POLLS.start(course_key, lambda course_key=course_key: take_snapshot(course_key))
+                 for course_key in course_keys]
+
+    async def finish_snapshots() -> List[CourseKey]:
+        try:
+            outcomes = await asyncio.gather(*(asyncio.shield(snapshot) for snapshot in snapshots))
+            failed = [course_key for course_key, outcome in zip(course_keys, outcomes)
+                      if outcome in (scheduler.FAILED, scheduler.THROTTLED)]
+
+            for course_key in failed:
+                WATCHERS.remove(course_key, channel_id)
+
+                if not WATCHERS.get_channels(course_key):
+                    delete_course(course_key)
+
+            return failed
+        finally:
+            # Only now may a worker poll the courses: either their modules are stored, or this
+            # channel no longer tracks them.
+            for course_key in course_keys:
+                PENDING_SNAPSHOTS[course_key] -= 1
+
+                if not PENDING_SNAPSHOTS[course_key]:
+                    del PENDING_SNAPSHOTS[course_key]
+
+    return asyncio.ensure_future(finish_snapshots())
+
+
+def get_assignable_course_keys() -> List[CourseKey]:
+    """
+    Returns the tracked courses that polling workers may poll, which are those without a snapshot
+    in progress. A worker polling a course before its snapshot is stored would announce every
+    existing module of the course as new.
+    """
+
+    return [course_key for course_key in WATCHERS.get_course_keys() if not PENDING_SNAPSHOTS[course_key]]
+
+
+def delete_course(course_key: CourseKey):
+    """
+    Stops tracking the given course in every channel and deletes everything stored about it.
+    """
+
+    WATCHERS.remove_course(course_key)
+    STORAGE.delete_course(course_key)
 
 
 class InaccessibleCanvasCourseException(Exception):
@@ -0,0 +1,139 @@
+"""
+A polling worker, which polls the share of the tracked courses that the coordinator assigns to
+it and sends the new modules it finds back to the coordinator. The coordinator runs in the bot
+process (see sharding.ShardCoordinator), which delivers the modules to Discord.
+
+main.py starts POLLING_WORKERS workers on the same host. More workers can be started on other
+hosts, each with a unique ID and access to the same storage:
+
+    python polling_worker.py --worker-id host2-0 --coordinator 10.0.0.1:8765
+"""
+
+import argparse
+import asyncio
+import traceback
+from typing import Callable, Dict, List, Set
+
+import periodic_tasks
+import scheduler
+import sharding
+from canvas_client import Course, ModuleRecord
+from canvas_hosts import CourseKey
+from metrics import METRICS
+from periodic_tasks import CourseCommit, PollNotifier
+
+# Seconds to wait before trying to reach the coordinator again
+RECONNECT_DELAY = 5
+
+
+class CoordinatorNotifier(PollNotifier):
+    """
+    Forwards what poll_courses finds to the coordinator. If the connection to the coordinator
+    is lost, sending fails, so the poll fails and its modules are not stored as known.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+
+    def _send(self, message: dict):
+        if self.writer.is_closing():
+            raise ConnectionError("Lost the connection to the coordinator")
+
+        self.writer.write(sharding.encode_message(message))
+
+    def send_new_modules(self, course_key: CourseKey, course: Course, modules: List[ModuleRecord],
+                         commit: CourseCommit) -> bool:
+        # Whether anybody still watches the course is up to the coordinator, which stops
+        # assigning the course once nobody does. The coordinator also stores the modules, together
+        # with the messages announcing them, so nothing is stored here.
+        self._send({"type": "new_modules", "course": course_key, "course_name": course.name,
+                    "modules": [sharding.encode_module(module) for module in modules], "commit": commit.to_dict()})
+        return True
+
+    def remove_inaccessible_course(self, course_key: CourseKey):
+        self._send({"type": "inaccessible", "course": course_key})
+
+    def finish(self):
+        if not self.writer.is_closing():
+            # The coordinator serves the metrics of all processes, so send it what this round recorded.
+            self.writer.write(sharding.encode_message({"type": "metrics", "series": METRICS.pop_changed_series()}))
+            self.writer.write(sharding.encode_message({"type": "sweep_done"}))
+
+
+class PollingWorker:
+    def __init__(self, worker_id: str, coordinator_host: str, coordinator_port: int):
+        self.worker_id = worker_id
+        self.coordinator_host = coordinator_host
+        self.coordinator_port = coordinator_port
+        self.course_keys: Set[CourseKey] = set()
+        self.writer = None
+        self.lanes = []
+
+    async def run(self):
+        # Like in the bot, every Canvas host has its own scheduler and lane.
+        for host, poll_scheduler in periodic_tasks.create_schedulers(periodic_tasks.CANVAS_INSTANCES).items():
+            lane = periodic_tasks.poll_when_due(poll_scheduler, self.get_course_keys_getter(host), self.poll)
+            self.lanes.append(asyncio.create_task(lane))
+
+        while True:
+            try:
+                reader, self.writer = await asyncio.open_connection(self.coordinator_host, self.coordinator_port,
+                                                                    limit=sharding.MAX_MESSAGE_BYTES)
+            except OSError:
+                print(f"[Error]: Could not reach the coordinator at {self.coordinator_host}:"
+                      f"{self.coordinator_port}; retrying in {RECONNECT_DELAY}s", flush=True)
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+
+            print(f"Polling worker {self.worker_id} connected to the coordinator", flush=True)
+            self.writer.write(sharding.encode_message({"type": "hello", "worker": self.worker_id}))
+            METRICS.mark_all_changed()
+
+            try:
+                while True:
+                    message = await sharding.read_message(reader)
+
+                    if message is None:
+                        break
+
+                    if message["type"] == "assign":
+                        self.course_keys = {CourseKey(*course_key) for course_key in message["courses"]}
+                        print(f"Polling worker {self.worker_id} was assigned {len(self.course_keys)} courses",
+                              flush=True)
+            except (ConnectionError, ValueError):
+                print(traceback.format_exc(), flush=True)
+
+            # Results can only be delivered through the coordinator, so stop polling until it is back.
+            print(f"[Error]: Polling worker {self.worker_id} lost the coordinator", flush=True)
+            self.writer.close()
+            self.writer = None
+            self.course_keys = set()
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    def get_course_keys_getter(self, host: str) -> Callable[[], List[CourseKey]]:
+        return lambda: [course_key for course_key in self.course_keys if course_key.host == host]
+
+    async def poll(self, course_keys: List[CourseKey]) -> Dict[CourseKey, str]:
+        if self.writer is None:
+            return {course_key: scheduler.FAILED for course_key in course_keys}
+
+        notifier = CoordinatorNotifier(self.writer)
+        outcomes = await periodic_tasks.poll_courses(course_keys, notifier)
+        notifier.finish()
+        return outcomes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--worker-id", required=True, help="unique name of this worker")
+    parser.add_argument("--coordinator", default=f"{sharding.COORDINATOR_HOST}:{sharding.COORDINATOR_PORT}",
+                        help="host:port of the coordinator")
+    args = parser.parse_args()
+    coordinator_host, coordinator_port = args.coordinator.rsplit(":", 1)
+
+    worker = PollingWorker(args.worker_id, coordinator_host, int(coordinator_port))
+    asyncio.run(worker.run())
+
+
+if __name__ == "__main__":
+    main()
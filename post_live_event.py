@@ -0,0 +1,68 @@
+"""
+Posts a sample Canvas Live Event to the bot's live events receiver, standing in for Canvas while
+testing. For example, to announce that a module was published in course 1234:
+
+    python post_live_event.py 1234 --event module_created --module-id 5678
+
+The bot only needs LIVE_EVENTS_ENABLED=1. It then checks course 1234 right away, as Canvas would
+have it do after a real event.
+"""
+
+import argparse
+import asyncio
+import time
+
+import aiohttp
+from dotenv import load_dotenv
+
+# The receiver's address and secret are read from the same .env file as the bot's.
+load_dotenv()
+
+import live_events
+from canvas_hosts import DEFAULT_CANVAS_HOST
+
+
+def create_event(event_name: str, host: str, course_id: int, module_id: int) -> dict:
+    """
+    Returns an event shaped like the ones Canvas sends for modules.
+    """
+
+    body = {"module_id": str(module_id), "context_type": "Course", "context_id": str(course_id),
+            "workflow_state": "active"}
+
+    if event_name.startswith("module_item_"):
+        body["module_item_id"] = str(module_id)
+
+    metadata = {"event_name": event_name, "hostname": host, "context_type": "Course", "context_id": str(course_id),
+                "event_time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+    return {"metadata": metadata, "body": body}
+
+
+async def post_events(url: str, events: list, secret: str = None):
+    headers = {"Authorization": f"Bearer {secret}"} if secret else {}
+
+    async with aiohttp.ClientSession() as session:
+        for event in events:
+            async with session.post(url, json=event, headers=headers) as response:
+                print(f"Posted {event['metadata']['event_name']} for course {event['metadata']['context_id']}: "
+                      f"HTTP {response.status}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("course_id", type=int)
+    parser.add_argument("--host", default=DEFAULT_CANVAS_HOST, help="Canvas host of the course")
+    parser.add_argument("--event", default="module_created", help="name of the event")
+    parser.add_argument("--module-id", type=int, default=1, help="ID of the module or module item the event is about")
+    parser.add_argument("--count", type=int, default=1, help="number of events to post, as in a burst")
+    parser.add_argument("--url", default=f"http://{live_events.LIVE_EVENTS_HOST}:{live_events.LIVE_EVENTS_PORT}"
+                                         f"{live_events.LIVE_EVENTS_PATH}")
+    parser.add_argument("--secret", default=live_events.LIVE_EVENTS_SECRET, help="LIVE_EVENTS_SECRET of the bot")
+    args = parser.parse_args()
+
+    events = [create_event(args.event, args.host, args.course_id, args.module_id) for _ in range(args.count)]
+    asyncio.run(post_events(args.url, events, args.secret))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+from typing import Any, Dict, Optional
+
+
+class ResponseCache:
+    """
+    Stores the HTTP validators (ETag and Last-Modified) of the Canvas responses that make up a
+    course's module list, so that the next poll can send conditional requests and skip courses
+    that have not changed.
+
+    The cache is stored by the course storage backend. Callers should store it only after the
+    course's modules have been stored, so that the cache never claims to know a response whose
+    modules were not saved.
+    """
+
+    def __init__(self, data: Dict[str, Any]):
+        self.pages: Dict[str, Dict[str, Any]] = data.get("pages", {})
+        self.course_updated_at: Optional[str] = data.get("course_updated_at")
+
+    def get_validators(self, url: str) -> Dict[str, str]:
+        """
+        Returns the conditional request headers to send for the given URL, which are empty if
+        the URL has not been cached.
+        """
+
+        page = self.pages.get(url, {})
+        headers = {}
+
+        if page.get("etag"):
+            headers["If-None-Match"] = page["etag"]
+        if page.get("last_modified"):
+            headers["If-Modified-Since"] = page["last_modified"]
+
+        return headers
+
+    def get_next_url(self, url: str) -> Optional[str]:
+        return self.pages.get(url, {}).get("next")
+
+    def get_total_size(self) -> int:
+        """
+        Returns the number of response bytes that a full download of the cached pages would cost.
+        """
+
+        return sum(page.get("size", 0) for page in self.pages.values())
+
+    def replace_pages(self, pages: Dict[str, Dict[str, Any]]):
+        self.pages = pages
+
+    @staticmethod
+    def make_page_entry(headers, next_url: Optional[str], size: int) -> Dict[str, Any]:
+        return {
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "next": next_url,
+            "size": size
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"pages": self.pages, "course_updated_at": self.course_updated_at}
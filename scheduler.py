@@ -0,0 +1,207 @@
+import heapq
+import os
+import random
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from canvas_hosts import CourseKey
+
+# Bounds and starting value, in seconds, of the interval between two polls of the same course
+MIN_POLL_INTERVAL = float(os.getenv("MIN_POLL_INTERVAL", "900"))
+MAX_POLL_INTERVAL = float(os.getenv("MAX_POLL_INTERVAL", "21600"))
+DEFAULT_POLL_INTERVAL = float(os.getenv("DEFAULT_POLL_INTERVAL", "3600"))
+# Each delay is randomly stretched or shrunk by up to this fraction, to spread polls out
+POLL_JITTER = float(os.getenv("POLL_JITTER", "0.1"))
+# Longest delay, in seconds, before retrying a course that failed or was throttled
+MAX_ERROR_BACKOFF = float(os.getenv("MAX_ERROR_BACKOFF", "21600"))
+# Courses that became due while the bot was stopped are polled at random times within this many
+# seconds after it starts again, instead of all at once
+OVERDUE_POLL_SPREAD = float(os.getenv("OVERDUE_POLL_SPREAD", "600"))
+
+# How much the interval shrinks after a poll that found new modules, and grows after one that did not
+CHANGED_INTERVAL_FACTOR = 0.5
+UNCHANGED_INTERVAL_FACTOR = 1.25
+
+# Outcomes of polling a course
+CHANGED = "changed"
+UNCHANGED = "unchanged"
+FAILED = "failed"
+THROTTLED = "throttled"
+REMOVED = "removed"
+
+
+class CourseSchedule:
+    __slots__ = ("interval", "next_due", "consecutive_errors", "last_polled")
+
+    def __init__(self, interval: float, next_due: float, consecutive_errors: int = 0,
+                 last_polled: Optional[float] = None):
+        self.interval = interval
+        self.next_due = next_due
+        self.consecutive_errors = consecutive_errors
+        self.last_polled = last_polled
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {attribute: getattr(self, attribute) for attribute in self.__slots__}
+
+
+class PollScheduler:
+    """
+    Decides when each course is polled. Every course has its own interval, which shrinks while
+    the course keeps changing and grows while it does not, within min_interval (by default,
+    MIN_POLL_INTERVAL) and MAX_POLL_INTERVAL. Courses that fail or are throttled are retried with
+    exponential backoff, starting at min_interval.
+
+    Due times are kept in a priority queue. A course that is being polled is not in the queue;
+    it is put back when its outcome is recorded.
+
+    Schedules can be saved and restored, so that a restarted bot keeps polling every course when
+    it is next due instead of starting over. Courses whose schedule changed since it was last
+    saved are returned by pop_changed_schedules.
+    """
+
+    def __init__(self, min_interval: float = MIN_POLL_INTERVAL):
+        self.min_interval = min_interval
+        self.max_interval = max(MAX_POLL_INTERVAL, min_interval)
+        self.default_interval = max(DEFAULT_POLL_INTERVAL, min_interval)
+        self.max_error_backoff = max(MAX_ERROR_BACKOFF, min_interval)
+        self.schedules: Dict[CourseKey, CourseSchedule] = {}
+        self.queue: List[Tuple[float, CourseKey]] = []
+        self.saved_schedules: Dict[CourseKey, Dict[str, Any]] = {}
+        self.changed: Set[CourseKey] = set()
+
+    @staticmethod
+    def _jitter(delay: float) -> float:
+        return delay * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+
+    def _push(self, course_key: CourseKey, next_due: float):
+        self.schedules[course_key].next_due = next_due
+        heapq.heappush(self.queue, (next_due, course_key))
+
+    def restore(self, schedules: Dict[CourseKey, Dict[str, Any]]):
+        """
+        Restores schedules saved from CourseSchedule.to_dict. A restored course resumes its saved
+        schedule once it is added; if it became due in the meantime, it is polled within
+        OVERDUE_POLL_SPREAD seconds.
+        """
+
+        self.saved_schedules.update(schedules)
+
+    def _restore_schedule(self, saved_schedule: Dict[str, Any]) -> CourseSchedule:
+        now = time.time()
+        interval = min(self.max_interval, max(self.min_interval, saved_schedule["interval"]))
+        next_due = min(saved_schedule["next_due"], now + self.max_interval)
+
+        if next_due <= now:
+            next_due = now + random.uniform(0, min(OVERDUE_POLL_SPREAD, interval))
+
+        return CourseSchedule(interval, next_due, saved_schedule["consecutive_errors"],
+                              saved_schedule["last_polled"])
+
+    def add(self, course_key: CourseKey, next_due: Optional[float] = None):
+        """
+        Starts scheduling the given course. If next_due is not given, the course resumes its
+        restored schedule, if any. Otherwise, the first poll happens at a random time within the
+        default interval, so that courses added together are spread out.
+        """
+
+        if course_key in self.schedules:
+            return
+
+        saved_schedule = self.saved_schedules.pop(course_key, None)
+
+        if next_due is None and saved_schedule is not None:
+            schedule = self._restore_schedule(saved_schedule)
+        else:
+            if next_due is None:
+                next_due = time.time() + random.uniform(0, self.default_interval)
+
+            schedule = CourseSchedule(self.default_interval, next_due)
+
+        self.schedules[course_key] = schedule
+        heapq.heappush(self.queue, (schedule.next_due, course_key))
+
+    def remove(self, course_key: CourseKey):
+        # The course's queue entry is skipped when it is popped.
+        self.schedules.pop(course_key, None)
+        self.changed.discard(course_key)
+
+    def sync(self, course_keys: Iterable[CourseKey]):
+        """
+        Schedules every given course that is not scheduled yet, and stops scheduling courses
+        that are not given.
+        """
+
+        course_keys = set(course_keys)
+
+        for course_key in course_keys - self.schedules.keys():
+            self.add(course_key)
+
+        for course_key in self.schedules.keys() - course_keys:
+            self.remove(course_key)
+
+    def _is_current(self, entry: Tuple[float, CourseKey]) -> bool:
+        schedule = self.schedules.get(entry[1])
+        return schedule is not None and schedule.next_due == entry[0]
+
+    def pop_due(self) -> List[CourseKey]:
+        """
+        Removes and returns every course that is due to be polled.
+        """
+
+        now = time.time()
+        due = []
+
+        while self.queue and self.queue[0][0] <= now:
+            entry = heapq.heappop(self.queue)
+
+            if self._is_current(entry):
+                due.append(entry[1])
+
+        return due
+
+    def get_seconds_until_next_due(self) -> float:
+        while self.queue and not self._is_current(self.queue[0]):
+            heapq.heappop(self.queue)
+
+        if not self.queue:
+            return self.default_interval
+
+        return max(0.0, self.queue[0][0] - time.time())
+
+    def record_outcome(self, course_key: CourseKey, outcome: str):
+        """
+        Reschedules a course that has just been polled, adapting its interval to the outcome.
+        """
+
+        schedule = self.schedules.get(course_key)
+
+        if schedule is None:
+            return
+
+        if outcome == REMOVED:
+            self.remove(course_key)
+            return
+
+        schedule.last_polled = time.time()
+        self.changed.add(course_key)
+
+        if outcome in (FAILED, THROTTLED):
+            schedule.consecutive_errors += 1
+            delay = min(self.max_error_backoff, self.min_interval * 2 ** (schedule.consecutive_errors - 1))
+        else:
+            schedule.consecutive_errors = 0
+            factor = CHANGED_INTERVAL_FACTOR if outcome == CHANGED else UNCHANGED_INTERVAL_FACTOR
+            schedule.interval = min(self.max_interval, max(self.min_interval, schedule.interval * factor))
+            delay = schedule.interval
+
+        self._push(course_key, time.time() + self._jitter(delay))
+
+    def pop_changed_schedules(self) -> Dict[CourseKey, Dict[str, Any]]:
+        """
+        Returns the schedule of every course whose outcome was recorded since this was last
+        called, to be saved.
+        """
+
+        schedules = {course_key: self.schedules[course_key].to_dict() for course_key in self.changed}
+        self.changed.clear()
+        return schedules
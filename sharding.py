@@ -0,0 +1,226 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import traceback
+from bisect import bisect
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+from canvas_client import Course, ModuleRecord
+from canvas_hosts import CourseKey
+from metrics import METRICS
+
+# Number of polling worker processes started by main.py. With 0, the bot polls Canvas itself.
+POLLING_WORKERS = int(os.getenv("POLLING_WORKERS", "0"))
+# Whether the bot accepts polling workers instead of polling Canvas itself. This is on whenever
+# main.py starts workers, and can be turned on to use only workers started on other hosts.
+COORDINATOR_ENABLED = os.getenv("COORDINATOR_ENABLED", "1" if POLLING_WORKERS > 0 else "0") == "1"
+# Address the coordinator listens on for polling workers
+COORDINATOR_HOST = os.getenv("COORDINATOR_HOST", "127.0.0.1")
+COORDINATOR_PORT = int(os.getenv("COORDINATOR_PORT", "8765"))
+# Seconds between two checks for tracked courses that need to be assigned to a worker
+ASSIGNMENT_INTERVAL = float(os.getenv("SHARD_ASSIGNMENT_INTERVAL", "10"))
+# Points each worker gets on the hash ring. More points spread the courses more evenly.
+RING_REPLICAS = 100
+# Longest message, in bytes, that the coordinator and its workers accept from each other
+MAX_MESSAGE_BYTES = 2 ** 24
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Maps keys to nodes by consistent hashing. Every node owns the keys that hash just before its
+    points on the ring, so adding or removing a node only moves the keys of that node.
+    """
+
+    def __init__(self, nodes: Iterable[str], replicas: int = RING_REPLICAS):
+        points = sorted((_hash(f"{node}#{replica}"), node) for node in nodes for replica in range(replicas))
+        self.hashes = [point[0] for point in points]
+        self.nodes = [point[1] for point in points]
+
+    def get_node(self, key: str) -> Optional[str]:
+        if not self.nodes:
+            return None
+
+        return self.nodes[bisect(self.hashes, _hash(key)) % len(self.nodes)]
+
+
+def encode_message(message: Dict[str, Any]) -> bytes:
+    """
+    Messages between the coordinator and its workers are JSON objects, one per line.
+    """
+
+    return json.dumps(message).encode() + b"\n"
+
+
+async def read_message(reader: asyncio.StreamReader) -> Optional[Dict[str, Any]]:
+    """
+    Returns the next message, or None once the connection is closed.
+    """
+
+    line = await reader.readline()
+    return json.loads(line) if line else None
+
+
+def encode_module(module: ModuleRecord) -> Dict[str, Any]:
+    return {attribute: getattr(module, attribute) for attribute in ModuleRecord.__slots__}
+
+
+def decode_module(encoded: Dict[str, Any]) -> ModuleRecord:
+    return ModuleRecord(**encoded)
+
+
+class ShardCoordinator:
+    """
+    Runs in the process that owns the Discord connection, and spreads the polling of tracked
+    courses over the polling workers connected to it (see polling_worker.py).
+
+    Each course is assigned to one connected worker by consistent hashing of its CourseKey, so a
+    worker joining or leaving only moves that worker's share of the courses. Workers poll their
+    courses on their own schedule and send back what they find, which the coordinator hands to a
+    notifier (see periodic_tasks.PollNotifier) exactly as if it had polled the courses itself.
+    What workers find is stored by the coordinator, together with the messages announcing it,
+    through the commits decoded by decode_commit. Workers only store their own polling schedules
+    (see periodic_tasks.poll_when_due), so SQLite writers in several processes wait for each other
+    (see storage.SQLITE_BUSY_TIMEOUT).
+    """
+
+    def __init__(self, get_course_keys: Callable[[], List[CourseKey]], create_notifier: Callable[[], Any],
+                 decode_commit: Callable[[Dict[str, Any]], Any]):
+        self.get_course_keys = get_course_keys
+        self.create_notifier = create_notifier
+        self.decode_commit = decode_commit
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.workers: Dict[str, asyncio.StreamWriter] = {}
+        self.notifiers: Dict[str, Any] = {}
+        self.assignments: Dict[str, Set[CourseKey]] = {}
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle_worker, COORDINATOR_HOST, COORDINATOR_PORT,
+                                                 limit=MAX_MESSAGE_BYTES)
+        print(f"Waiting for polling workers on {COORDINATOR_HOST}:{COORDINATOR_PORT}", flush=True)
+
+        # Assignments change when courses are tracked or forgotten, as well as when workers come and go.
+        while True:
+            self.assign_courses()
+            await asyncio.sleep(ASSIGNMENT_INTERVAL)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.close()
+
+        workers = self.workers
+        self.workers = {}
+
+        for worker_id, writer in workers.items():
+            self.notifiers.pop(worker_id).finish()
+            writer.close()
+
+    def assign_courses(self):
+        """
+        Sends every worker whose share of the courses has changed its new share.
+        """
+
+        ring = HashRing(self.workers)
+        shares = {worker_id: set() for worker_id in self.workers}
+
+        for course_key in self.get_course_keys():
+            worker_id = ring.get_node(str(course_key))
+
+            if worker_id is not None:
+                shares[worker_id].add(course_key)
+
+        for worker_id, share in shares.items():
+            if share != self.assignments.get(worker_id):
+                self.assignments[worker_id] = share
+                self.workers[worker_id].write(encode_message({"type": "assign", "courses": sorted(share)}))
+
+    async def _handle_worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        worker_id = None
+
+        try:
+            hello = await read_message(reader)
+
+            if hello is None or hello.get("type") != "hello":
+                return
+
+            worker_id = str(hello["worker"])
+
+            if worker_id in self.workers:
+                print(f"[Error]: Polling worker {worker_id} connected twice; dropping the old connection", flush=True)
+                self.workers[worker_id].close()
+                # Deliver what the old connection's notifier has collected, e.g. digest messages.
+                self.notifiers.pop(worker_id).finish()
+
+            self.workers[worker_id] = writer
+            self.notifiers[worker_id] = self.create_notifier()
+            self.assignments.pop(worker_id, None)
+            print(f"Polling worker {worker_id} connected", flush=True)
+            self.assign_courses()
+
+            while True:
+                message = await read_message(reader)
+
+                if message is None:
+                    break
+
+                try:
+                    self._handle_message(worker_id, message)
+                except (sqlite3.Error, OSError):
+                    # The storage may only be busy, so the worker stays connected. Whatever could
+                    # not be stored is found again by the worker's next poll.
+                    print(f"[Error]: Failed to store a message from polling worker {worker_id}", flush=True)
+                    print(traceback.format_exc(), flush=True)
+        except (ConnectionError, ValueError, KeyError):
+            print(f"[Error]: Lost polling worker {worker_id}", flush=True)
+            print(traceback.format_exc(), flush=True)
+        finally:
+            writer.close()
+
+            # The worker may have reconnected already, in which case its new connection stays.
+            if worker_id is not None and self.workers.get(worker_id) is writer:
+                del self.workers[worker_id]
+                self.assignments.pop(worker_id, None)
+                self.notifiers.pop(worker_id).finish()
+                print(f"Polling worker {worker_id} disconnected", flush=True)
+                self.assign_courses()
+
+    def _handle_message(self, worker_id: str, message: Dict[str, Any]):
+        notifier = self.notifiers[worker_id]
+
+        if message["type"] == "new_modules":
+            course_key = CourseKey(*message["course"])
+            course = Course({"id": course_key.course_id, "name": message["course_name"]})
+            modules = [decode_module(module) for module in message["modules"]]
+            notifier.send_new_modules(course_key, course, modules, self.decode_commit(message["commit"]))
+        elif message["type"] == "inaccessible":
+            notifier.remove_inaccessible_course(CourseKey(*message["course"]))
+        elif message["type"] == "metrics":
+            METRICS.add_remote_series(worker_id, message["series"])
+        elif message["type"] == "sweep_done":
+            notifier.finish()
+            self.notifiers[worker_id] = self.create_notifier()
+
+
+def start_workers() -> List[subprocess.Popen]:
+    """
+    Starts POLLING_WORKERS polling worker processes, which connect to the coordinator.
+    """
+
+    worker_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "polling_worker.py")
+    return [subprocess.Popen([sys.executable, worker_script, "--worker-id", str(worker_id)])
+            for worker_id in range(POLLING_WORKERS)]
+
+
+def stop_workers(workers: List[subprocess.Popen]):
+    for worker in workers:
+        worker.terminate()
+
+    for worker in workers:
+        worker.wait()
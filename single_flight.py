@@ -0,0 +1,47 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time. A call made while another call with the same key
+    is in progress does not run again; it waits for the call in progress and gets its result or
+    exception instead.
+
+    Callers that stop waiting, e.g. because they were cancelled, do not cancel the shared call,
+    since other callers may still be waiting for it. Calls are only cancelled by cancel_all.
+    """
+
+    def __init__(self):
+        self.calls: Dict[Hashable, asyncio.Future] = {}
+
+    def is_in_flight(self, key: Hashable) -> bool:
+        return key in self.calls
+
+    def start(self, key: Hashable, function: Callable[[], Awaitable[T]]) -> "asyncio.Future[T]":
+        """
+        Starts a call, unless a call with the same key is in progress, and returns the call in
+        progress without waiting for it. The call counts as in progress from now on.
+        """
+
+        future = self.calls.get(key)
+
+        if future is None:
+            future = asyncio.ensure_future(function())
+            self.calls[key] = future
+            future.add_done_callback(lambda _: self.calls.pop(key, None))
+
+        return future
+
+    async def run(self, key: Hashable, function: Callable[[], Awaitable[T]]) -> T:
+        return await asyncio.shield(self.start(key, function))
+
+    def cancel_all(self):
+        """
+        Cancels every call in progress, e.g. before the resources the calls use are closed.
+        """
+
+        for future in list(self.calls.values()):
+            future.cancel()
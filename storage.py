@@ -0,0 +1,582 @@
+import abc
+import json
+import os
+import pathlib
+import shutil
+import sqlite3
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+import util
+from canvas_hosts import CourseKey
+from module_ids import ModuleIdLog, ModuleIdSet
+from outbox import OutboxMessage
+
+# Name shown for a course whose name has not been stored
+UNKNOWN_COURSE_NAME = "<Course name not found>"
+# Seconds a SQLite write waits for another process, such as a polling worker saving its schedules,
+# to finish writing before it fails
+SQLITE_BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", "10"))
+
+
+class CourseStorage(abc.ABC):
+    """
+    Stores the state of every tracked course: its name, the Discord channels watching it (its
+    "watchers"), the IDs of all of its known modules, the response cache used to send
+    conditional requests to Canvas, and its polling schedule. It also keeps the outbox of
+    notifications that have not been sent to Discord yet.
+
+    Courses are identified by a CourseKey, since course IDs are only unique within one Canvas
+    host. Course, channel and module IDs are always ints.
+    """
+
+    @abc.abstractmethod
+    def get_course_keys(self) -> List[CourseKey]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_course_name(self, course_key: CourseKey) -> str:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_course_name(self, course_key: CourseKey, course_name: str):
+        raise NotImplementedError
+
+    def set_course_names(self, course_names: Dict[CourseKey, str]):
+        """
+        Sets the names of every course in the given dictionary, in one batch.
+        """
+
+        for course_key, course_name in course_names.items():
+            self.set_course_name(course_key, course_name)
+
+    @abc.abstractmethod
+    def get_watchers(self, course_key: CourseKey) -> List[int]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_all_watchers(self) -> Dict[CourseKey, Set[int]]:
+        """
+        Returns the watchers of every course, keyed by course.
+        """
+
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def replace_watchers(self, watchers: Dict[CourseKey, Set[int]]):
+        """
+        Replaces the watchers of every course in the given dictionary, in one batch.
+        """
+
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_module_ids(self, course_key: CourseKey) -> ModuleIdSet:
+        raise NotImplementedError
+
+    def has_module_ids(self, course_key: CourseKey) -> bool:
+        return len(self.get_module_ids(course_key)) != 0
+
+    @abc.abstractmethod
+    def add_module_ids(self, course_key: CourseKey, module_ids: Iterable[int]):
+        """
+        Adds the given IDs to the known module IDs of the given course. Known IDs are never
+        removed, so a module that is unpublished and published again is not announced twice.
+        """
+
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_response_cache(self, course_key: CourseKey) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_response_cache(self, course_key: CourseKey, response_cache: Dict[str, Any]):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_schedules(self) -> Dict[CourseKey, Dict[str, Any]]:
+        """
+        Returns the saved polling schedule of every course, keyed by course. Each schedule is a
+        dict returned by scheduler.CourseSchedule.to_dict.
+        """
+
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_schedules(self, schedules: Dict[CourseKey, Dict[str, Any]]):
+        """
+        Saves the polling schedules of every course in the given dictionary, in one batch. Schedules
+        of courses that are no longer stored are ignored.
+        """
+
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_course(self, course_key: CourseKey):
+        """
+        Forgets everything stored about the given course. Its messages in the outbox are kept.
+        """
+
+        raise NotImplementedError
+
+    def commit_new_modules(self, course_key: CourseKey, module_ids: Iterable[int], response_cache: Dict[str, Any],
+                           messages: List[OutboxMessage]):
+        """
+        Stores the IDs of a course's new modules together with its response cache and the outbox
+        messages announcing the modules.
+
+        Backends with transactions store all of them at once. Otherwise, the messages are stored
+        first and the response cache last, so that neither the module IDs nor the cache can vouch
+        for modules whose messages were lost. A crash in between can then only make the modules be
+        found again, and their messages are not added twice.
+        """
+
+        self.add_outbox_messages(messages)
+        self.add_module_ids(course_key, module_ids)
+        self.set_response_cache(course_key, response_cache)
+
+    @abc.abstractmethod
+    def add_outbox_messages(self, messages: List[OutboxMessage]):
+        """
+        Adds the given messages to the outbox, except those whose dedup key is already in it.
+        """
+
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_outbox_messages(self) -> List[OutboxMessage]:
+        """
+        Returns every message in the outbox, oldest first.
+        """
+
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_outbox_progress(self, message: OutboxMessage):
+        """
+        Stores how many of the given message's embeds have been sent.
+        """
+
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_outbox_messages(self, dedup_keys: Iterable[str]):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class FileStorage(CourseStorage):
+    """
+    Stores each course in its own directory inside the courses directory, grouped by Canvas
+    host: courses/<host>/<course_id>. The directory contains the files course_name.txt,
+    watchers.txt, modules.txt and response_cache.json.
+
+    Each message in the outbox is a JSON file in the outbox directory, named after its dedup key.
+    """
+
+    def __init__(self, courses_directory: str, default_host: str, outbox_directory: Optional[str]):
+        self.courses_directory = courses_directory
+        self.default_host = default_host
+        self.outbox_directory = outbox_directory
+
+    def get_course_directory(self, course_key: CourseKey) -> str:
+        return f"{self.courses_directory}/{course_key.host}/{course_key.course_id}"
+
+    def get_course_file_path(self, course_key: CourseKey, file_name: str) -> str:
+        return f"{self.get_course_directory(course_key)}/{file_name}"
+
+    def get_course_keys(self) -> List[CourseKey]:
+        if not os.path.exists(self.courses_directory):
+            return []
+
+        course_keys = []
+
+        for folder_name in os.listdir(self.courses_directory):
+            folder_path = f"{self.courses_directory}/{folder_name}"
+            course_id_str = folder_name.split()[0]
+
+            if course_id_str.isdigit():
+                # Older versions of the bot kept courses of the default host directly in the courses
+                # directory, and some put the course name after the ID in the folder name.
+                course_key = CourseKey(self.default_host, int(course_id_str))
+                pathlib.Path(f"{self.courses_directory}/{self.default_host}").mkdir(exist_ok=True)
+                os.rename(folder_path, self.get_course_directory(course_key))
+                course_keys.append(course_key)
+            elif os.path.isdir(folder_path):
+                course_keys.extend(CourseKey(folder_name, int(course_folder_name))
+                                   for course_folder_name in os.listdir(folder_path)
+                                   if course_folder_name.isdigit())
+
+        # A legacy folder moved into the default host's directory may have been listed twice.
+        return list(dict.fromkeys(course_keys))
+
+    def get_course_name(self, course_key: CourseKey) -> str:
+        try:
+            with open(self.get_course_file_path(course_key, "course_name.txt"), 'r') as f:
+                return f.readline().rstrip('\n')
+        except FileNotFoundError:
+            return UNKNOWN_COURSE_NAME
+
+    def set_course_name(self, course_key: CourseKey, course_name: str):
+        course_name_file = self.get_course_file_path(course_key, "course_name.txt")
+        util.ensure_file_exists(course_name_file)
+
+        with open(course_name_file, 'w') as f:
+            f.write(f"{course_name}\n")
+
+    def get_watchers(self, course_key: CourseKey) -> List[int]:
+        try:
+            with open(self.get_course_file_path(course_key, "watchers.txt"), 'r') as f:
+                return [int(line) for line in f.read().splitlines() if line]
+        except FileNotFoundError:
+            return []
+
+    def get_all_watchers(self) -> Dict[CourseKey, Set[int]]:
+        return {course_key: set(self.get_watchers(course_key)) for course_key in self.get_course_keys()}
+
+    def replace_watchers(self, watchers: Dict[CourseKey, Set[int]]):
+        for course_key, channel_ids in watchers.items():
+            # Do not recreate the directory of a course that has been deleted.
+            if channel_ids or os.path.exists(self.get_course_directory(course_key)):
+                util.write_lines_atomically(self.get_course_file_path(course_key, "watchers.txt"), channel_ids)
+
+    def _get_module_id_log(self, course_key: CourseKey) -> ModuleIdLog:
+        return ModuleIdLog(self.get_course_file_path(course_key, "modules.txt"),
+                           self.get_course_file_path(course_key, "modules.log"))
+
+    def get_module_ids(self, course_key: CourseKey) -> ModuleIdSet:
+        return self._get_module_id_log(course_key).read()
+
+    def has_module_ids(self, course_key: CourseKey) -> bool:
+        return not self._get_module_id_log(course_key).is_empty()
+
+    def add_module_ids(self, course_key: CourseKey, module_ids: Iterable[int]):
+        self._get_module_id_log(course_key).append(module_ids)
+
+    def get_response_cache(self, course_key: CourseKey) -> Dict[str, Any]:
+        try:
+            with open(self.get_course_file_path(course_key, "response_cache.json"), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def set_response_cache(self, course_key: CourseKey, response_cache: Dict[str, Any]):
+        cache_file = self.get_course_file_path(course_key, "response_cache.json")
+        util.ensure_file_exists(cache_file)
+
+        with open(f"{cache_file}.tmp", 'w') as f:
+            json.dump(response_cache, f)
+
+        os.replace(f"{cache_file}.tmp", cache_file)
+
+    def get_schedules(self) -> Dict[CourseKey, Dict[str, Any]]:
+        schedules = {}
+
+        for course_key in self.get_course_keys():
+            try:
+                with open(self.get_course_file_path(course_key, "schedule.json"), 'r') as f:
+                    schedules[course_key] = json.load(f)
+            except (FileNotFoundError, ValueError):
+                pass
+
+        return schedules
+
+    def set_schedules(self, schedules: Dict[CourseKey, Dict[str, Any]]):
+        for course_key, schedule in schedules.items():
+            if not os.path.exists(self.get_course_directory(course_key)):
+                continue
+
+            schedule_file = self.get_course_file_path(course_key, "schedule.json")
+
+            with open(f"{schedule_file}.tmp", 'w') as f:
+                json.dump(schedule, f)
+
+            os.replace(f"{schedule_file}.tmp", schedule_file)
+
+    def delete_course(self, course_key: CourseKey):
+        shutil.rmtree(self.get_course_directory(course_key), ignore_errors=True)
+
+    def _get_outbox_file_path(self, dedup_key: str) -> str:
+        return f"{self.outbox_directory}/{dedup_key}.json"
+
+    def add_outbox_messages(self, messages: List[OutboxMessage]):
+        for message in messages:
+            if not os.path.exists(self._get_outbox_file_path(message.dedup_key)):
+                self.set_outbox_progress(message)
+
+    def get_outbox_messages(self) -> List[OutboxMessage]:
+        if not os.path.exists(self.outbox_directory):
+            return []
+
+        messages = []
+
+        for file_name in os.listdir(self.outbox_directory):
+            if file_name.endswith(".json"):
+                with open(f"{self.outbox_directory}/{file_name}", 'r') as f:
+                    messages.append(OutboxMessage.from_dict(json.load(f)))
+
+        return sorted(messages, key=lambda message: message.created_at)
+
+    def set_outbox_progress(self, message: OutboxMessage):
+        util.write_lines_atomically(self._get_outbox_file_path(message.dedup_key), [json.dumps(message.to_dict())])
+
+    def delete_outbox_messages(self, dedup_keys: Iterable[str]):
+        for dedup_key in dedup_keys:
+            try:
+                os.remove(self._get_outbox_file_path(dedup_key))
+            except FileNotFoundError:
+                pass
+
+
+class SQLiteStorage(CourseStorage):
+    """
+    Stores all courses in a single SQLite database. Watchers are indexed by both course and
+    channel, so looking up the courses tracked by a channel does not scan every course.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS courses (
+            host TEXT NOT NULL,
+            course_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            response_cache TEXT,
+            PRIMARY KEY (host, course_id)
+        );
+        CREATE TABLE IF NOT EXISTS watchers (
+            host TEXT NOT NULL,
+            course_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            PRIMARY KEY (host, course_id, channel_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS watchers_by_channel ON watchers (channel_id, host, course_id);
+        CREATE TABLE IF NOT EXISTS modules (
+            host TEXT NOT NULL,
+            course_id INTEGER NOT NULL,
+            module_id INTEGER NOT NULL,
+            PRIMARY KEY (host, course_id, module_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS schedules (
+            host TEXT NOT NULL,
+            course_id INTEGER NOT NULL,
+            interval REAL NOT NULL,
+            next_due REAL NOT NULL,
+            consecutive_errors INTEGER NOT NULL,
+            last_polled REAL,
+            PRIMARY KEY (host, course_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS metadata (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS outbox (
+            dedup_key TEXT PRIMARY KEY,
+            channel_id INTEGER NOT NULL,
+            host TEXT,
+            course_id INTEGER,
+            content TEXT,
+            embeds TEXT NOT NULL,
+            digest INTEGER NOT NULL,
+            sent_embeds INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, database_path: str, default_host: str):
+        util.ensure_file_exists(database_path)
+        self.connection = sqlite3.connect(database_path, timeout=SQLITE_BUSY_TIMEOUT)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.default_host = default_host
+        self.connection.executescript(self.SCHEMA)
+
+    def get_course_keys(self) -> List[CourseKey]:
+        return [CourseKey(*row) for row in self.connection.execute("SELECT host, course_id FROM courses")]
+
+    def get_course_name(self, course_key: CourseKey) -> str:
+        row = self.connection.execute("SELECT name FROM courses WHERE host = ? AND course_id = ?",
+                                      course_key).fetchone()
+        return row[0] if row else UNKNOWN_COURSE_NAME
+
+    def set_course_name(self, course_key: CourseKey, course_name: str):
+        with self.connection:
+            self.connection.execute("INSERT INTO courses (host, course_id, name) VALUES (?, ?, ?) "
+                                    "ON CONFLICT (host, course_id) DO UPDATE SET name = excluded.name",
+                                    (*course_key, course_name))
+
+    def set_course_names(self, course_names: Dict[CourseKey, str]):
+        with self.connection:
+            self.connection.executemany("INSERT INTO courses (host, course_id, name) VALUES (?, ?, ?) "
+                                        "ON CONFLICT (host, course_id) DO UPDATE SET name = excluded.name",
+                                        [(*course_key, course_name)
+                                         for course_key, course_name in course_names.items()])
+
+    def get_watchers(self, course_key: CourseKey) -> List[int]:
+        return [row[0] for row in
+                self.connection.execute("SELECT channel_id FROM watchers WHERE host = ? AND course_id = ?",
+                                        course_key)]
+
+    def get_all_watchers(self) -> Dict[CourseKey, Set[int]]:
+        watchers = {}
+
+        for host, course_id, channel_id in self.connection.execute("SELECT host, course_id, channel_id "
+                                                                   "FROM watchers"):
+            watchers.setdefault(CourseKey(host, course_id), set()).add(channel_id)
+
+        return watchers
+
+    def replace_watchers(self, watchers: Dict[CourseKey, Set[int]]):
+        with self.connection:
+            self.connection.executemany("DELETE FROM watchers WHERE host = ? AND course_id = ?", list(watchers))
+            self.connection.executemany("INSERT INTO watchers (host, course_id, channel_id) VALUES (?, ?, ?)",
+                                        [(*course_key, channel_id) for course_key, channel_ids in watchers.items()
+                                         for channel_id in channel_ids])
+
+    def get_module_ids(self, course_key: CourseKey) -> ModuleIdSet:
+        return ModuleIdSet(row[0] for row in
+                           self.connection.execute("SELECT module_id FROM modules WHERE host = ? AND course_id = ?",
+                                                   course_key))
+
+    def has_module_ids(self, course_key: CourseKey) -> bool:
+        return self.connection.execute("SELECT 1 FROM modules WHERE host = ? AND course_id = ? LIMIT 1",
+                                       course_key).fetchone() is not None
+
+    def add_module_ids(self, course_key: CourseKey, module_ids: Iterable[int]):
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO modules (host, course_id, module_id) VALUES (?, ?, ?)",
+                                        [(*course_key, module_id) for module_id in module_ids])
+
+    def get_response_cache(self, course_key: CourseKey) -> Dict[str, Any]:
+        row = self.connection.execute("SELECT response_cache FROM courses WHERE host = ? AND course_id = ?",
+                                      course_key).fetchone()
+        return json.loads(row[0]) if row and row[0] else {}
+
+    def set_response_cache(self, course_key: CourseKey, response_cache: Dict[str, Any]):
+        with self.connection:
+            self.connection.execute("UPDATE courses SET response_cache = ? WHERE host = ? AND course_id = ?",
+                                    (json.dumps(response_cache), *course_key))
+
+    def get_schedules(self) -> Dict[CourseKey, Dict[str, Any]]:
+        rows = self.connection.execute("SELECT host, course_id, interval, next_due, consecutive_errors, last_polled "
+                                       "FROM schedules")
+        return {CourseKey(host, course_id): {"interval": interval, "next_due": next_due,
+                                             "consecutive_errors": consecutive_errors, "last_polled": last_polled}
+                for host, course_id, interval, next_due, consecutive_errors, last_polled in rows}
+
+    def set_schedules(self, schedules: Dict[CourseKey, Dict[str, Any]]):
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO schedules (host, course_id, interval, next_due, "
+                                        "consecutive_errors, last_polled) SELECT ?, ?, ?, ?, ?, ? WHERE EXISTS "
+                                        "(SELECT 1 FROM courses WHERE host = ? AND course_id = ?)",
+                                        [(*course_key, schedule["interval"], schedule["next_due"],
+                                          schedule["consecutive_errors"], schedule["last_polled"], *course_key)
+                                         for course_key, schedule in schedules.items()])
+
+    def delete_course(self, course_key: CourseKey):
+        with self.connection:
+            self.connection.execute("DELETE FROM schedules WHERE host = ? AND course_id = ?", course_key)
+            self.connection.execute("DELETE FROM watchers WHERE host = ? AND course_id = ?", course_key)
+            self.connection.execute("DELETE FROM modules WHERE host = ? AND course_id = ?", course_key)
+            self.connection.execute("DELETE FROM courses WHERE host = ? AND course_id = ?", course_key)
+
+    @staticmethod
+    def _get_outbox_row(message: OutboxMessage) -> tuple:
+        host, course_id = message.course_key or (None, None)
+        return (message.dedup_key, message.channel_id, host, course_id, message.content, json.dumps(message.embeds),
+                message.digest, message.sent_embeds, message.created_at)
+
+    def _insert_outbox_messages(self, messages: List[OutboxMessage]):
+        self.connection.executemany("INSERT OR IGNORE INTO outbox (dedup_key, channel_id, host, course_id, content, "
+                                    "embeds, digest, sent_embeds, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                    [self._get_outbox_row(message) for message in messages])
+
+    def commit_new_modules(self, course_key: CourseKey, module_ids: Iterable[int], response_cache: Dict[str, Any],
+                           messages: List[OutboxMessage]):
+        with self.connection:
+            self._insert_outbox_messages(messages)
+            self.connection.executemany("INSERT OR IGNORE INTO modules (host, course_id, module_id) VALUES (?, ?, ?)",
+                                        [(*course_key, module_id) for module_id in module_ids])
+            self.connection.execute("UPDATE courses SET response_cache = ? WHERE host = ? AND course_id = ?",
+                                    (json.dumps(response_cache), *course_key))
+
+    def add_outbox_messages(self, messages: List[OutboxMessage]):
+        with self.connection:
+            self._insert_outbox_messages(messages)
+
+    def get_outbox_messages(self) -> List[OutboxMessage]:
+        rows = self.connection.execute("SELECT dedup_key, channel_id, host, course_id, content, embeds, digest, "
+                                       "sent_embeds, created_at FROM outbox ORDER BY rowid")
+        return [OutboxMessage(dedup_key, channel_id, CourseKey(host, course_id) if host else None, content,
+                              json.loads(embeds), bool(digest), sent_embeds, created_at)
+                for dedup_key, channel_id, host, course_id, content, embeds, digest, sent_embeds, created_at in rows]
+
+    def set_outbox_progress(self, message: OutboxMessage):
+        with self.connection:
+            self.connection.execute("UPDATE outbox SET sent_embeds = ? WHERE dedup_key = ?",
+                                    (message.sent_embeds, message.dedup_key))
+
+    def delete_outbox_messages(self, dedup_keys: Iterable[str]):
+        with self.connection:
+            self.connection.executemany("DELETE FROM outbox WHERE dedup_key = ?",
+                                        [(dedup_key,) for dedup_key in dedup_keys])
+
+    def get_metadata(self, key: str) -> Optional[str]:
+        row = self.connection.execute("SELECT value FROM metadata WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_metadata(self, key: str, value: str):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)", (key, value))
+
+    def migrate_from_files(self, courses_directory: str):
+        """
+        Copies every course stored in the old directory layout (see FileStorage) into the
+        database. This only happens once; afterwards the directories are left untouched.
+        """
+
+        if self.get_metadata("migrated_from_files") or not os.path.exists(courses_directory):
+            return
+
+        file_storage = FileStorage(courses_directory, self.default_host, None)
+        course_keys = file_storage.get_course_keys()
+
+        with self.connection:
+            for course_key in course_keys:
+                self.connection.execute("INSERT OR REPLACE INTO courses (host, course_id, name, response_cache) "
+                                        "VALUES (?, ?, ?, ?)",
+                                        (*course_key, file_storage.get_course_name(course_key),
+                                         json.dumps(file_storage.get_response_cache(course_key))))
+                self.connection.executemany("INSERT OR IGNORE INTO watchers (host, course_id, channel_id) "
+                                            "VALUES (?, ?, ?)",
+                                            [(*course_key, channel_id)
+                                             for channel_id in file_storage.get_watchers(course_key)])
+                self.connection.executemany("INSERT OR IGNORE INTO modules (host, course_id, module_id) "
+                                            "VALUES (?, ?, ?)",
+                                            [(*course_key, module_id)
+                                             for module_id in file_storage.get_module_ids(course_key)])
+
+            self.connection.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES ('migrated_from_files', '1')")
+
+        print(f"Migrated {len(course_keys)} courses from {courses_directory} to SQLite", flush=True)
+
+    def close(self):
+        self.connection.close()
+
+
+def create_storage(backend: str, courses_directory: str, database_path: str, default_host: str,
+                   outbox_directory: str) -> CourseStorage:
+    """
+    Returns the storage backend with the given name ("sqlite" or "files"). The SQLite backend
+    imports courses from the directory layout the first time it is used. Courses stored before
+    the bot supported several Canvas hosts are assigned to default_host. The outbox directory is
+    only used by the "files" backend.
+    """
+
+    if backend == "files":
+        return FileStorage(courses_directory, default_host, outbox_directory)
+    elif backend == "sqlite":
+        sqlite_storage = SQLiteStorage(database_path, default_host)
+        sqlite_storage.migrate_from_files(courses_directory)
+        return sqlite_storage
+    else:
+        raise ValueError(f"Unknown storage backend: {backend}")
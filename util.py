@@ -1,10 +1,9 @@
 import pathlib
-import periodic_tasks
 import os
-from typing import List, Union
+from typing import AsyncIterator, Iterable, Optional
 
-from canvasapi.course import Course
-from canvasapi.module import Module, ModuleItem
+from canvas_client import CanvasClient, ModuleRecord, has_complete_items
+from response_cache import ResponseCache
 
 
 def ensure_file_exists(file_path):
@@ -19,59 +18,48 @@ def ensure_file_exists(file_path):
         pass
 
 
-class CanvasUtil:
-    @staticmethod
-    def get_modules(course: Course) -> List[Union[Module, ModuleItem]]:
-        """
-        Returns a list of all modules for the given course.
-        """
-
-        all_modules = []
+def write_lines_atomically(file_path: str, lines: Iterable):
+    """
+    Replaces the file with given path with one line per element of lines. The lines are written
+    to a temporary file and flushed to disk first, so a crash never leaves a partially-written
+    file behind.
+    """
 
-        for module in course.get_modules():
-            all_modules.append(module)
+    ensure_file_exists(file_path)
+    temp_file_path = f"{file_path}.tmp"
 
-            for item in module.get_module_items():
-                all_modules.append(item)
+    with open(temp_file_path, 'w') as f:
+        for line in lines:
+            f.write(f"{line}\n")
 
-        return all_modules
+        f.flush()
+        os.fsync(f.fileno())
 
-    @staticmethod
-    def write_modules_to_file(file_path: str, modules: List[Union[Module, ModuleItem]]):
-        """
-        Stores the IDs of all modules in file with given path.
-        """
+    os.replace(temp_file_path, file_path)
 
-        with open(file_path, 'w') as f:
-            for module in modules:
-                f.write(f"{module.id}\n")
-
-    @staticmethod
-    def get_course_directory(course_id: str) -> str:
-        return f"{periodic_tasks.COURSES_DIRECTORY}/{course_id}"
-
-    @staticmethod
-    def get_course_name_file_path_by_course_dir(course_directory: str):
-        return f"{course_directory}/course_name.txt"
 
+class CanvasUtil:
     @staticmethod
-    def get_watchers_file_path_by_course_dir(course_directory: str) -> str:
-        return f"{course_directory}/watchers.txt"
+    async def get_modules(client: CanvasClient, course_id: int,
+                          cache: Optional[ResponseCache] = None) -> AsyncIterator[ModuleRecord]:
+        """
+        Yields a record of every module and module item of the course with the given ID, as soon as
+        the page containing it arrives. Only one page of the module list is held at a time.
 
-    @staticmethod
-    def get_modules_file_path(course_id: str) -> str:
-        return f"{CanvasUtil.get_course_directory(course_id)}/modules.txt"
+        Module items are requested inline with the module list, so most courses need only one
+        paginated request. Items are fetched separately only for modules whose inline item list
+        was truncated by Canvas.
 
-    @staticmethod
-    def get_watchers_file_path_by_course_id(course_id: str) -> str:
-        return CanvasUtil.get_watchers_file_path_by_course_dir(CanvasUtil.get_course_directory(course_id))
+        If a response cache is given, the module list is requested conditionally, and NotModified
+        is raised if it has not changed.
+        """
 
-    @staticmethod
-    def get_course_name_file_path_by_course_id(course_id: str):
-        return CanvasUtil.get_course_name_file_path_by_course_dir(CanvasUtil.get_course_directory(course_id))
+        async for module in client.get_modules(course_id, cache):
+            yield ModuleRecord.from_module(module)
 
-    @staticmethod
-    def store_course_name_locally(course_id: str, course_name: str):
-        file = CanvasUtil.get_course_name_file_path_by_course_id(course_id)
-        with open(file, 'w+') as f:
-            f.write(f"{course_name}\n")
+            if has_complete_items(module):
+                for item in module["items"]:
+                    yield ModuleRecord.from_module_item(item)
+            else:
+                async for item in client.get_module_items(course_id, module["id"]):
+                    yield ModuleRecord.from_module_item(item)
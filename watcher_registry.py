@@ -0,0 +1,137 @@
+import asyncio
+import os
+import traceback
+from typing import Dict, Iterable, List, Optional, Set
+
+from canvas_hosts import CourseKey
+from storage import CourseStorage
+
+# Seconds to wait after a change before writing it to storage, so that changes made close
+# together are written in one batch
+WRITE_BEHIND_DELAY = float(os.getenv("WATCHERS_WRITE_BEHIND_DELAY", "2"))
+
+
+class WatcherRegistry:
+    """
+    Keeps the watchers of every course in memory, indexed by both course and channel. The
+    registry is loaded from storage once and is the only writer of watchers afterwards.
+
+    Changes are written behind: a changed course is marked dirty and all dirty courses are
+    written to storage in one batch shortly afterwards. Nothing is written if nothing changed.
+    """
+
+    def __init__(self, course_storage: CourseStorage):
+        self.storage = course_storage
+        self._channels_by_course: Dict[CourseKey, Set[int]] = {}
+        self._courses_by_channel: Dict[int, Set[CourseKey]] = {}
+        self._dirty_courses: Set[CourseKey] = set()
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+        for course_key, channel_ids in course_storage.get_all_watchers().items():
+            for channel_id in channel_ids:
+                self._link(course_key, channel_id)
+
+    def _link(self, course_key: CourseKey, channel_id: int):
+        self._channels_by_course.setdefault(course_key, set()).add(channel_id)
+        self._courses_by_channel.setdefault(channel_id, set()).add(course_key)
+
+    def _unlink(self, course_key: CourseKey, channel_id: int):
+        channels = self._channels_by_course.get(course_key)
+        if channels is not None:
+            channels.discard(channel_id)
+
+        courses = self._courses_by_channel.get(channel_id)
+        if courses is not None:
+            courses.discard(course_key)
+            if not courses:
+                del self._courses_by_channel[channel_id]
+
+    def get_course_keys(self, host: Optional[str] = None) -> List[CourseKey]:
+        """
+        Returns every course being watched, or only those on the given Canvas host.
+        """
+
+        return [course_key for course_key in self._channels_by_course if host is None or course_key.host == host]
+
+    def get_channels(self, course_key: CourseKey) -> List[int]:
+        return list(self._channels_by_course.get(course_key, ()))
+
+    def get_courses(self, channel_id: int) -> List[CourseKey]:
+        return sorted(self._courses_by_channel.get(channel_id, ()))
+
+    def add(self, course_key: CourseKey, channel_id: int) -> bool:
+        """
+        Adds the given channel to the course's watchers. Returns True if the channel was added
+        and False if the channel was already watching the course.
+        """
+
+        if channel_id in self._channels_by_course.get(course_key, ()):
+            return False
+
+        self._link(course_key, channel_id)
+        self._mark_dirty(course_key)
+        return True
+
+    def remove(self, course_key: CourseKey, channel_id: int) -> bool:
+        """
+        Removes the given channel from the course's watchers. Returns True if the channel was
+        removed and False if the channel was not watching the course.
+        """
+
+        if channel_id not in self._channels_by_course.get(course_key, ()):
+            return False
+
+        self._unlink(course_key, channel_id)
+        self._mark_dirty(course_key)
+        return True
+
+    def prune_channels(self, channel_ids: Iterable[int]):
+        """
+        Removes the given channels from the watchers of every course, in one batch.
+        """
+
+        for channel_id in channel_ids:
+            for course_key in list(self._courses_by_channel.get(channel_id, ())):
+                self._unlink(course_key, channel_id)
+                self._mark_dirty(course_key)
+
+    def remove_course(self, course_key: CourseKey):
+        """
+        Forgets the given course. The caller is responsible for deleting the course from storage,
+        so no watcher write is scheduled for it.
+        """
+
+        for channel_id in self._channels_by_course.pop(course_key, set()):
+            self._unlink(course_key, channel_id)
+
+        self._dirty_courses.discard(course_key)
+
+    def _mark_dirty(self, course_key: CourseKey):
+        self._dirty_courses.add(course_key)
+
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(WRITE_BEHIND_DELAY, self.flush)
+
+    def flush(self):
+        """
+        Writes the watchers of every changed course to storage in one batch.
+        """
+
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        if not self._dirty_courses:
+            return
+
+        dirty_courses = self._dirty_courses
+        self._dirty_courses = set()
+
+        try:
+            self.storage.replace_watchers({course_key: set(self._channels_by_course.get(course_key, ()))
+                                           for course_key in dirty_courses})
+        except Exception:
+            # Keep the changes so that the next flush retries them.
+            self._dirty_courses |= dirty_courses
+            print("[Error]: Failed to write watchers to storage", flush=True)
+            print(traceback.format_exc(), flush=True)